@@ -0,0 +1,148 @@
+"""
+    assets.py
+
+    Serves the files of web_client precompressed and fingerprinted, cacheable forever.
+    All files share one fingerprint, a hash of their contents, as a path segment, so that relative imports between
+    them keep working:
+
+        app.register_blueprint(assets.app, url_prefix='/@appchen/assets')
+        assets.url('codemirror/lib/codemirror.js')  # /@appchen/assets/<fingerprint>/codemirror/lib/codemirror.js
+
+    The files are read and gzip compressed once when the blueprint is registered. The compressed variant is sent
+    if the client accepts gzip.
+
+    Pages and modules still referring to the files at their former location, /appchen/web_client/ or the bare
+    specifier appchen/web_client/, are served with fingerprinted URLs by send_rewritten(), and so are the assets.
+"""
+import hashlib
+import logging
+import pathlib
+import re
+import zlib
+from typing import Dict, NamedTuple, Optional
+
+from flask import Blueprint, Response, redirect, request, send_from_directory
+
+from appchen.serialization import json_response
+
+asset_folder = pathlib.Path(__file__).parent / 'web_client'
+# Files smaller than this are not worth compressing.
+min_compress_size = 1024
+
+_mimetype_by_suffix = {
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.html': 'text/html; charset=utf-8',
+    '.ts': 'application/typescript; charset=utf-8',
+}
+
+app = Blueprint('assets', __name__)
+
+
+class Asset(NamedTuple):
+    data: bytes
+    gzipped: Optional[bytes]
+    mimetype: str
+    etag: str
+
+
+# A reference to a file of web_client at its former location, within a string or url().
+_legacy_reference = re.compile(r'''(?<=['"(])/?appchen/web_client/([\w./-]+)''')
+
+_asset_by_path: Dict[str, Asset] = dict()
+_url_prefix = ''
+fingerprint = ''
+
+
+def _gzip(data: bytes) -> bytes:
+    # A zlib gzip stream has no modification time, so the output only depends on the data.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def build():
+    """Reads, fingerprints and compresses all files of the asset_folder."""
+    global fingerprint
+    data_by_path = dict()
+    tree_hash = hashlib.sha256()
+    for path in sorted(asset_folder.rglob('*')):
+        if path.suffix not in _mimetype_by_suffix or not path.is_file():
+            continue
+        name = path.relative_to(asset_folder).as_posix()
+        data_by_path[name] = path.read_bytes()
+        tree_hash.update(f'{name}:{hashlib.sha256(data_by_path[name]).hexdigest()}\n'.encode())
+    # The rewritten files only depend on the original files, so the fingerprint is that of the originals.
+    new_fingerprint = tree_hash.hexdigest()[:16]
+    asset_by_path = dict()
+    for name, data in data_by_path.items():
+        mimetype = _mimetype_by_suffix[pathlib.PurePosixPath(name).suffix]
+        if not name.endswith('.ts'):
+            data = _rewrite(data.decode('utf-8'), new_fingerprint, data_by_path).encode('utf-8')
+        gzipped = _gzip(data) if len(data) >= min_compress_size else None
+        if gzipped is not None and len(gzipped) >= len(data):
+            gzipped = None
+        asset_by_path[name] = Asset(data, gzipped, mimetype, hashlib.sha256(data).hexdigest())
+    _asset_by_path.clear()
+    _asset_by_path.update(asset_by_path)
+    fingerprint = new_fingerprint
+    logging.info('Built %s assets with fingerprint %s', len(asset_by_path), fingerprint)
+
+
+def _rewrite(text: str, version: str, paths) -> str:
+    def replace(match):
+        path = match.group(1)
+        return f'{_url_prefix}/{version}/{path}' if path in paths else match.group(0)
+
+    return _legacy_reference.sub(replace, text)
+
+
+@app.record_once
+def configure(state):
+    global _url_prefix
+    _url_prefix = state.url_prefix or ''
+    build()
+
+
+def url(path: str) -> str:
+    """Returns the fingerprinted URL of the asset."""
+    return f'{_url_prefix}/{fingerprint}/{path}'
+
+
+def rewrite(text: str) -> str:
+    """Replaces the references to files of web_client at their former location by their fingerprinted URLs.
+    Returns the text unchanged if the blueprint is not registered."""
+    return _rewrite(text, fingerprint, _asset_by_path)
+
+
+def send_rewritten(directory, filename: str) -> Response:
+    """Sends a page or module of the application, see rewrite(). It is revalidated on each use, because the URLs
+    change with the fingerprint."""
+    response = send_from_directory(directory, filename)
+    response.direct_passthrough = False
+    data = rewrite(response.get_data(as_text=True)).encode('utf-8')
+    response.set_data(data)
+    response.set_etag(hashlib.sha256(data).hexdigest())
+    response.headers.pop('Last-Modified', None)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+@app.route('/<version>/<path:path>', methods=['GET'])
+def get_asset(version: str, path: str):
+    asset = _asset_by_path.get(path)
+    if asset is None:
+        return json_response(dict(error='Asset not found'), 404)
+    if version != fingerprint:
+        # An outdated link, which must not be cached forever.
+        return redirect(url(path))
+
+    if asset.gzipped is not None and request.accept_encodings['gzip']:
+        response = Response(asset.gzipped, mimetype=asset.mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(asset.etag + '-gzip')
+    else:
+        response = Response(asset.data, mimetype=asset.mimetype)
+        response.set_etag(asset.etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
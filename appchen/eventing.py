@@ -1,6 +1,11 @@
 
 import abc
-from typing import Dict, List, Callable
+import asyncio
+import collections
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
 
 
 # Designed along asyncio.AbstractEventLoop
@@ -11,6 +16,96 @@ class EventLoop(abc.ABC):
         pass
 
 
+class ImmediateEventLoop(EventLoop):
+    """Calls the callbacks right away on the calling thread."""
+
+    def call_soon(self, callback: Callable[..., None], *args):
+        callback(*args)
+
+
+def _ordering_key(args: tuple) -> Optional[str]:
+    """Callbacks are ordered by the type of the event they are called with."""
+    return getattr(args[0], 'type', None) if args else None
+
+
+_CALL = Tuple[Callable[..., Any], tuple]
+
+
+class ThreadPoolEventLoop(EventLoop):
+    """Calls the callbacks on a thread pool, so that slow listeners do not block the reader of the event stream.
+    Callbacks for events of the same type are called one after the other in order, while different types
+    are processed concurrently."""
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='event_loop')
+        self._lock = threading.Lock()
+        self._pending_by_key: Dict[Optional[str], Deque[_CALL]] = dict()
+
+    def call_soon(self, callback: Callable[..., None], *args):
+        key = _ordering_key(args)
+        with self._lock:
+            pending = self._pending_by_key.get(key)
+            if pending is not None:
+                pending.append((callback, args))
+                return
+            self._pending_by_key[key] = collections.deque()
+        self._executor.submit(self._run, key, callback, args)
+
+    def _run(self, key: Optional[str], callback: Callable[..., None], args: tuple):
+        while True:
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception('Event listener failed')
+            with self._lock:
+                pending = self._pending_by_key[key]
+                if not pending:
+                    del self._pending_by_key[key]
+                    return
+                callback, args = pending.popleft()
+            try:
+                # Resubmit instead of looping, so that a busy type does not starve the others.
+                self._executor.submit(self._run, key, callback, args)
+                return
+            except RuntimeError:
+                pass  # After shutdown the pending callbacks are called on this thread.
+
+    def shutdown(self, wait: bool = True):
+        """Stops accepting callbacks. With wait, returns after all pending callbacks were called."""
+        self._executor.shutdown(wait)
+
+
+class AsyncioEventLoop(EventLoop):
+    """Calls the callbacks on the running asyncio loop, coroutine callbacks are awaited.
+    Callbacks for events of the same type are called one after the other in order, while different types
+    are processed concurrently. Must be used from within the asyncio loop."""
+
+    def __init__(self):
+        self._pending_by_key: Dict[Optional[str], Deque[_CALL]] = dict()
+
+    def call_soon(self, callback: Callable[..., None], *args):
+        key = _ordering_key(args)
+        pending = self._pending_by_key.get(key)
+        if pending is not None:
+            pending.append((callback, args))
+            return
+        pending = self._pending_by_key[key] = collections.deque([(callback, args)])
+        asyncio.ensure_future(self._run(key, pending))
+
+    async def _run(self, key: Optional[str], pending: Deque[_CALL]):
+        try:
+            while pending:
+                callback, args = pending.popleft()
+                try:
+                    result = callback(*args)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception:
+                    logging.exception('Event listener failed')
+        finally:
+            del self._pending_by_key[key]
+
+
 class Event:
     type: str
 
@@ -24,16 +119,16 @@ class EventSource:
         self.event_loop = event_loop
 
     def dispatch_event(self, event: Event):
-        if event.type in self._event_listeners_by_type:
-            for callback in self._event_listeners_by_type[event.type]:
-                self.event_loop.call_soon(callback, event)
+        callbacks = self._event_listeners_by_type.get(event.type)
+        if callbacks:
+            call_soon = self.event_loop.call_soon
+            for callback in callbacks:
+                call_soon(callback, event)
 
     def add_event_listener(self, topic: str, callback: EVENT_LISTENER):
         """Adds an event listener for a given topic.
         """
-        if type not in self._event_listeners_by_type:
-            self._event_listeners_by_type[topic] = []
-        self._event_listeners_by_type[topic].append(callback)
+        self._event_listeners_by_type.setdefault(topic, []).append(callback)
 
     def route(self, event_type: str):
         """A decorator that is used to add an event listener for a given topic.
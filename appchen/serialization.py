@@ -0,0 +1,66 @@
+"""
+    serialization.py
+
+    The JSON serializer used for all events and JSON responses of appchen.
+    The fastest available backend is used by default, i.e. orjson if installed and the standard json module otherwise.
+    All backends serialize datetime and date objects to ISO 8601 strings and bson ObjectIds to their hex string,
+    so producers can hand over MongoDB documents as they are.
+
+    Use set_serializer() to select a backend by name or to install your own function.
+"""
+import datetime
+import json
+from typing import Any, Callable, Dict, Union
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from bson import ObjectId
+except ImportError:
+    ObjectId = None
+
+SERIALIZER = Callable[[Any], str]
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if ObjectId is not None and isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def json_dumps(obj) -> str:
+    return json.dumps(obj, default=_default)
+
+
+def orjson_dumps(obj) -> str:
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+serializers: Dict[str, SERIALIZER] = dict(json=json_dumps)
+if orjson is not None:
+    serializers['orjson'] = orjson_dumps
+
+_dumps: SERIALIZER = orjson_dumps if orjson is not None else json_dumps
+
+
+def set_serializer(serializer: Union[str, SERIALIZER]):
+    """Selects the serializer by its name in serializers, or installs the specified function."""
+    global _dumps
+    _dumps = serializers[serializer] if isinstance(serializer, str) else serializer
+
+
+def dumps(obj) -> str:
+    """Serializes the object to a JSON string with the current serializer."""
+    return _dumps(obj)
+
+
+def json_response(obj, status: int = 200):
+    """Replacement for flask.jsonify() using the current serializer."""
+    return Response(_dumps(obj), status=status, mimetype='application/json')
@@ -0,0 +1,159 @@
+"""
+    aioclient.py
+
+    An asyncio EventSource, with the same API as client.EventSource but without a thread per stream.
+    Listeners may be plain functions or coroutine functions, see eventing.AsyncioEventLoop.
+
+    Usage:
+        es = EventSource('http://localhost:8080/@appchen/web_client/stream/connection?topics=zen')
+
+        @es.route('zen')
+        async def on_zen(event):
+            print(event.data)
+
+        es.connect()
+        ...
+        es.close()
+"""
+import asyncio
+import logging
+import random
+import ssl
+import zlib
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from appchen import eventing
+from appchen.server_send_events.parser import Event, EventStreamParser
+
+# A number representing the state of the connection, see https://developer.mozilla.org/en-US/docs/Web/API/EventSource
+CONNECTING = 0
+OPEN = 1
+CLOSED = 2
+
+
+class EventSource(eventing.EventSource):
+    """
+    Partially implements https://developer.mozilla.org/en-US/docs/Web/API/EventSource on top of asyncio.
+    On connection loss the client reconnects with exponential backoff, starting with the retry delay send by the
+    server, and resumes with the last event id.
+    """
+
+    # Upper limit of the reconnection delay in milliseconds.
+    max_retry = 60000
+
+    def __init__(self, url: str, headers: Dict[str, str] = None):
+        super().__init__(eventing.AsyncioEventLoop())
+        self.url = url
+        self.headers = headers or {}
+        self.readyState = CONNECTING
+        self.last_event_id: Optional[str] = None
+        # Reconnection delay in milliseconds.
+        self.retry = 3000
+        self._task: Optional[asyncio.Future] = None
+
+    def connect(self) -> asyncio.Future:
+        """Non-Web/API/EventSource method to defer connection AFTER event listeners have been added.
+        Must be called from within the event loop."""
+        self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    def close(self):
+        """Closes the HTTP connection. Must be called from within the event loop."""
+        self.readyState = CLOSED
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        failures = 0
+        while self.readyState != CLOSED:
+            try:
+                await self._stream()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except (OSError, EOFError, ValueError, zlib.error) as e:
+                logging.debug('EventSource %s: %r', self.url, e)
+                self._process_event(Event(data=str(e), event='error'))
+                failures += 1
+            if self.readyState == CLOSED:
+                return
+            self.readyState = CONNECTING
+            delay = min(self.retry * 2 ** max(failures - 1, 0), self.max_retry)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0) / 1000)
+
+    async def _stream(self):
+        """Streams the events of one HTTP connection. Returns when the server closes the connection."""
+        url = urlsplit(self.url)
+        secure = url.scheme == 'https'
+        port = url.port or (443 if secure else 80)
+        reader, writer = await asyncio.open_connection(
+            url.hostname, port, ssl=ssl.create_default_context() if secure else None)
+        try:
+            defaults = {'Host': url.netloc, 'Accept': 'text/event-stream', 'Cache-Control': 'no-cache',
+                        'Accept-Encoding': 'gzip, deflate', 'Connection': 'close'}
+            # The headers of the caller win, whatever their case.
+            custom = {name.lower() for name in self.headers}
+            headers = {name: value for name, value in defaults.items() if name.lower() not in custom}
+            headers.update(self.headers)
+            if self.last_event_id:
+                headers['Last-Event-ID'] = self.last_event_id
+            path = (url.path or '/') + ('?' + url.query if url.query else '')
+            request = f'GET {path} HTTP/1.1\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+            writer.write(request.encode('latin-1'))
+
+            status_line, *header_lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+            status = int(status_line.split(' ')[1])
+            response_headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+            if status != 200 or not response_headers.get('content-type', '').startswith('text/event-stream'):
+                # As with browsers, this is not retried.
+                self.readyState = CLOSED
+                self._process_event(Event(data=f'HTTP status {status}', event='error'))
+                return
+
+            self.readyState = OPEN
+            decompressor = None
+            if response_headers.get('content-encoding') in ('gzip', 'deflate'):
+                decompressor = zlib.decompressobj(wbits=32 + zlib.MAX_WBITS)  # Detects gzip or zlib header.
+            parser = EventStreamParser()
+            chunked = response_headers.get('transfer-encoding', '').lower() == 'chunked'
+            async for chunk in (_read_chunked(reader) if chunked else _read_until_eof(reader)):
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                for event in parser.feed(chunk):
+                    self._process_event(event)
+        finally:
+            writer.close()
+
+    def _process_event(self, event: Event):
+        if event.id is not None:
+            self.last_event_id = event.id
+        if event.retry is not None:
+            self.retry = event.retry
+        if event.event == 'connection_open':
+            event.event = 'open'
+        event.type = event.event  # https://developer.mozilla.org/en-US/docs/Web/API/Event/type
+        self.dispatch_event(event)
+
+
+async def _read_until_eof(reader: asyncio.StreamReader):
+    while True:
+        chunk = await reader.read(64 * 1024)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _read_chunked(reader: asyncio.StreamReader):
+    while True:
+        size_line = await reader.readuntil(b'\r\n')
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            return
+        chunk = await reader.readexactly(size)
+        await reader.readexactly(2)
+        yield chunk
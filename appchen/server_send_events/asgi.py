@@ -0,0 +1,255 @@
+"""
+    asgi.py
+
+    An asyncio based engine for server send events, exposed as an ASGI application.
+    It serves the same endpoints as the Flask blueprint in routes.py, i.e.
+
+        GET  /stream/connection
+        POST /stream/subscribe
+        GET  /stream/topics
+        GET  /stream/metrics
+
+    but each open connection only costs a coroutine instead of a blocked thread.
+    Producers keep using server.broadcast() and Connection.emit() from any (synchronous) thread.
+
+    Usage:
+        uvicorn appchen.server_send_events.asgi:app --port 8081
+
+    or mount `app` under the prefix /@appchen/web_client with the ASGI router of your choice.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qs
+from typing import Callable, Dict, List, Optional, Tuple
+
+from appchen import serialization
+from appchen.server_send_events import compression, metrics, routes, server
+from appchen.server_send_events.compression import StreamCompressor
+from appchen.server_send_events.queues import EventQueue, QueueClosed
+
+class _Handoff:
+    """Wakes up coroutines waiting on queues filled from producer threads, with a single loop wake-up per burst.
+    A broadcast to 10k idle connections thus does not result in 10k calls to loop.call_soon_threadsafe()."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._lock = threading.Lock()
+        self._pending: List['AsyncEventQueue'] = []
+
+    def wakeup(self, queue: 'AsyncEventQueue'):
+        with self._lock:
+            self._pending.append(queue)
+            if len(self._pending) > 1:
+                return  # A flush is already scheduled.
+        self.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for queue in pending:
+            queue.not_empty.set()
+
+
+class AsyncEventQueue(EventQueue):
+    """An EventQueue which can be filled from any thread and is drained by a coroutine running in the event loop."""
+
+    def __init__(self, handoff: _Handoff):
+        super().__init__(server.queue_maxsize, server.overflow_policy)
+        self._handoff = handoff
+        self.not_empty = asyncio.Event()
+
+    async def get_async(self):
+        """Same as EventQueue.get(), but without a timeout."""
+        while True:
+            with self._lock:
+                if self._items or self.closed:
+                    return self._pop()
+                self.not_empty.clear()
+            await self.not_empty.wait()
+
+    async def get_batch_async(self, max_bytes: int, max_delay: float = 0.0) -> List:
+        """Same as EventQueue.get_batch()."""
+        batch = [await self.get_async()]
+        with self._lock:
+            size = self._drain(batch, len(batch[0].data), max_bytes)
+        if size < max_bytes and max_delay > 0:
+            deadline = time.monotonic() + max_delay
+            while size < max_bytes:
+                with self._lock:
+                    if self.closed:
+                        break
+                    if not self._items:
+                        self.not_empty.clear()
+                if not self.not_empty.is_set():
+                    remaining = deadline - time.monotonic()
+                    try:
+                        await asyncio.wait_for(self.not_empty.wait(), max(remaining, 0))
+                    except asyncio.TimeoutError:
+                        break
+                with self._lock:
+                    size = self._drain(batch, size, max_bytes)
+        return batch
+
+    def _wakeup(self):
+        self._handoff.wakeup(self)
+
+
+class AsyncConnection(server.Connection):
+    """A Connection served by a coroutine."""
+
+    def __init__(self, handoff: _Handoff, last_event_id: str = None):
+        super().__init__(queue=AsyncEventQueue(handoff), last_event_id=last_event_id)
+
+    async def events(self, content_encoding: str = None):
+        """Same as Connection.event_generator()."""
+        compress = StreamCompressor(content_encoding, server.compression_level).compress if content_encoding else bytes
+        try:
+            while True:
+                frames = await self.queue.get_batch_async(server.batch_max_bytes, server.batch_max_delay)
+                self.last_write = time.monotonic()
+                yield compress(server.join_frames(frames))
+                if metrics.enabled:
+                    metrics.observe_written(frames)
+        except QueueClosed:
+            if self.queue.overflowed:
+                yield compress(self.overflow_frame().data)
+        finally:
+            self.remove()
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionAbortedError()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def _send_json(send, obj, status: int = 200):
+    body = serialization.dumps(obj).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class StreamApp:
+    """The ASGI application."""
+
+    def __init__(self):
+        self._handoff: Optional[_Handoff] = None
+        self._endpoints: Dict[Tuple[str, str], Callable] = {
+            ('GET', '/stream/connection'): self.open_connection,
+            ('POST', '/stream/subscribe'): self.post_subscribe,
+            ('GET', '/stream/topics'): self.get_topics,
+            ('GET', '/stream/metrics'): self.get_metrics,
+        }
+
+    def handoff(self) -> _Handoff:
+        loop = asyncio.get_event_loop()
+        if self._handoff is None or self._handoff.loop is not loop:
+            self._handoff = _Handoff(loop)
+        return self._handoff
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise NotImplementedError(scope['type'])
+
+        path: str = scope['path']
+        root_path: str = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+
+        endpoint = self._endpoints.get((scope['method'], path))
+        if endpoint is None:
+            if any(p == path for _, p in self._endpoints):
+                await _send_json(send, dict(error='Method not allowed'), 405)
+            else:
+                await _send_json(send, dict(error='Not found'), 404)
+            return
+        await endpoint(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def open_connection(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        topics = [topic for topic in query.get('topics', [''])[0].split(',') if topic]
+        headers = dict(scope['headers'])
+        content_encoding = compression.negotiate(
+            headers.get(b'accept-encoding', b'').decode('latin-1'), server.compression_level)
+        last_event_id = headers.get(b'last-event-id')
+        if last_event_id is not None:
+            last_event_id = last_event_id.decode('latin-1')
+        else:
+            last_event_id = query.get('lastEventId', [None])[0]
+        connection = AsyncConnection(self.handoff(), last_event_id)
+        connection.emit('connection_open', dict(connectionId=connection.id, topics=topics))
+        if topics:
+            for future in routes.subscribe(connection, topics):
+                future.add_done_callback(routes.log_snapshot_error)
+
+        disconnected = False
+
+        async def watch_disconnect():
+            nonlocal disconnected
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected = True
+            connection.queue.close()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            response_headers = [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]
+            if content_encoding:
+                response_headers += [(b'content-encoding', content_encoding.encode()), (b'vary', b'accept-encoding')]
+            await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+            async for chunk in connection.events(content_encoding):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not disconnected:
+                # The server ended the stream, for example on overflow.
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except OSError as e:
+            logging.debug('Connection %s lost: %r', connection.id, e)
+        finally:
+            watcher.cancel()
+
+    async def post_subscribe(self, scope, receive, send):
+        request_data: dict = json.loads(await _read_body(receive))
+        connection_id: str = request_data['connectionId']
+        topics: List[str] = request_data['topics']
+        connection = server.get_connection_by_id(connection_id)
+        if connection is None:
+            await _send_json(send, dict(error='Connection not found'), 404)
+            return
+        # State events are computed by synchronous (and potentially slow) functions on the snapshot pool.
+        for future in routes.subscribe(connection, topics):
+            await asyncio.wrap_future(future)
+        await _send_json(send, 'Done')
+
+    async def get_topics(self, scope, receive, send):
+        await _send_json(send, list(server.declared_topics.values()))
+
+    async def get_metrics(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        await _send_json(send, server.metrics_snapshot(int(query.get('connections', ['100'])[0])))
+
+
+app = StreamApp()
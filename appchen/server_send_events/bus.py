@@ -0,0 +1,164 @@
+"""
+    bus.py
+
+    Fan-out backends for server.broadcast().
+    The default LocalBus delivers events to the connections of the current process only.
+    With multiple server processes behind a load balancer, all processes must use a bus which reaches the others,
+    for example a UnixSocketBus on one host:
+
+        server.set_bus(UnixSocketBus('/run/myapp/bus'))
+
+    Note that a connection id is only known to the process serving the connection. So either route subscribe
+    requests to the same process (sticky sessions), or pass the topics when opening the connection.
+"""
+import abc
+import collections
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+DELIVER = Callable[[str, str], None]
+
+
+class Bus(abc.ABC):
+    """Publishes serialized events to the deliver function of all processes, including the current one."""
+
+    # Whether published events only reach the current process.
+    local = False
+
+    def __init__(self):
+        self.deliver: Optional[DELIVER] = None
+        # Number of events by topic which could not be sent to another process, counted once per process.
+        # All connections of that process miss the event, see /stream/metrics.
+        self.dropped = collections.Counter()
+        self._dropped_lock = threading.Lock()
+
+    def start(self, deliver: DELIVER):
+        """Called by server.set_bus() with the function delivering an event to the local connections."""
+        self.deliver = deliver
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def publish(self, topic: str, data: str):
+        pass
+
+    def _drop(self, topic: str, count: int = 1):
+        with self._dropped_lock:
+            self.dropped[topic] += count
+
+
+class LocalBus(Bus):
+    local = True
+
+    def publish(self, topic: str, data: str):
+        self.deliver(topic, data)
+
+
+class UnixSocketBus(Bus):
+    """
+    Each process binds a unix datagram socket in the specified directory.
+    An event is delivered locally and send as one datagram to every other socket in that directory.
+    Sockets left behind by dead processes are removed.
+    Sending never blocks: If the buffer of a receiving process is full, the event is dropped for that process.
+
+    The size of an event is limited by the socket buffers, which the operating system caps silently, on Linux at
+    net.core.wmem_max and net.core.rmem_max. The effective limit is message_size_limit, larger events are dropped
+    for all other processes. Dropped events are counted in Bus.dropped.
+    """
+
+    # The requested socket buffer size, the largest event including its topic.
+    max_message_size = 4 * 1024 * 1024
+    # Seconds after which the directory is listed again to find new processes.
+    peer_refresh_interval = 1.0
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path: Optional[str] = None
+        self._receiver: Optional[socket.socket] = None
+        self._sender: Optional[socket.socket] = None
+        # The socket paths of the other processes, replaced as a whole.
+        self._peers: Tuple[str, ...] = ()
+        self._peers_listed = float('-inf')
+        # The largest message the socket buffers granted by the operating system can carry.
+        self.message_size_limit = 0
+
+    def start(self, deliver: DELIVER):
+        super().start(deliver)
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self.path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.max_message_size)
+        self._receiver.bind(self.path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.max_message_size)
+        # Linux reports twice the granted size, including its bookkeeping overhead.
+        self.message_size_limit = min(self.max_message_size,
+                                      self._sender.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) // 2,
+                                      self._receiver.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2)
+        if self.message_size_limit < self.max_message_size:
+            logging.warning('Bus events are limited to %s bytes by the socket buffer sizes of the operating system',
+                            self.message_size_limit)
+        threading.Thread(target=self._receive, name='unix-socket-bus', daemon=True).start()
+
+    def close(self):
+        if self._receiver is not None:
+            self._receiver.close()
+            self._sender.close()
+            os.unlink(self.path)
+            self._receiver = None
+
+    def _receive(self):
+        receiver = self._receiver
+        while True:
+            try:
+                message = receiver.recv(self.max_message_size)
+            except OSError:
+                return  # Closed
+            topic, _, data = message.partition(b'\0')
+            try:
+                self.deliver(topic.decode(), data.decode())
+            except Exception:
+                logging.exception('Could not deliver %s', topic)
+
+    def _peer_paths(self) -> Tuple[str, ...]:
+        now = time.monotonic()
+        if now - self._peers_listed >= self.peer_refresh_interval:
+            self._peers_listed = now
+            self._peers = tuple(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                                if name.endswith('.sock') and os.path.join(self.directory, name) != self.path)
+        return self._peers
+
+    def publish(self, topic: str, data: str):
+        self.deliver(topic, data)
+        message = topic.encode() + b'\0' + data.encode()
+        peers = self._peer_paths()
+        if len(message) > self.message_size_limit:
+            if peers:
+                logging.error('Could not publish %s of %s bytes, the limit is %s', topic, len(message),
+                              self.message_size_limit)
+                self._drop(topic, len(peers))
+            return
+        for path in peers:
+            try:
+                self._sender.sendto(message, socket.MSG_DONTWAIT, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                logging.info('Removing stale bus socket %s', path)
+                self._peers = tuple(peer for peer in self._peers if peer != path)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                logging.warning('Dropped %s for %s, its buffer is full', topic, path)
+                self._drop(topic)
+            except OSError as e:
+                logging.error('Could not publish %s to %s: %r', topic, path, e)
+                self._drop(topic)
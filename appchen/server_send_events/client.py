@@ -1,52 +1,51 @@
 """A very small EventSource implementation based on the sseclient package."""
+import collections
 import time
-import codecs
 import logging
-import re
 import threading
-from typing import Callable
 import http.client
+import socket
+from typing import Optional
 
-from sseclient import SSEClient, Event, end_of_field
+from sseclient import SSEClient
 from appchen import eventing
+from appchen.server_send_events.parser import Event, EventStreamParser
 import requests
 
 
 # TODO: Dump this an go async
 class SSEClient1(SSEClient):
-    """Patches very slow detection of event field delimiters."""
+    """Replaces the string based parsing of sseclient, which is quadratic in the size of an event,
+    by the incremental parser.EventStreamParser."""
     def __init__(self, url):
-        super().__init__(url, chunk_size=10*1024)
+        self._parser = EventStreamParser()
+        self._pending = collections.deque()
+        self._closed = False
+        # sseclient reads the raw stream, so it must not accept a compressed one.
+        super().__init__(url, chunk_size=10*1024, headers={'Accept-Encoding': 'identity'})
 
     def _event_complete(self):
         assert False
 
     def __next__(self):
-        decoder = codecs.getincrementaldecoder(
-            self.resp.encoding)(errors='replace')
-        pos = 0
-        while end_of_field.search(self.buf, pos) is None:
+        while not self._pending:
             try:
                 next_chunk = next(self.resp_iterator)
                 if not next_chunk:
                     raise EOFError()
-                pos = max(0, len(self.buf) - 4)
-                self.buf += decoder.decode(next_chunk)
+                self._pending.extend(self._parser.feed(next_chunk))
             except (StopIteration, requests.RequestException, EOFError, http.client.IncompleteRead) as e:
+                if self._closed:
+                    raise StopIteration
                 time.sleep(self.retry / 1000.0)
                 self._connect()
 
                 # The SSE spec only supports resuming from a whole message, so
                 # if we have half a message we should throw it out.
-                head, sep, tail = self.buf.rpartition('\n')
-                self.buf = head + sep
+                self._parser.reset()
                 continue
 
-        # Split the complete event (up to the end_of_field) into event_string,
-        # and retain anything after the current complete event in self.buf
-        # for next time.
-        (event_string, self.buf) = re.split(end_of_field, self.buf, maxsplit=1)
-        msg = Event.parse(event_string)
+        msg = self._pending.popleft()
 
         # If the server requests a specific retry delay, we need to honor it.
         if msg.retry:
@@ -59,10 +58,15 @@ class SSEClient1(SSEClient):
 
         return msg
 
-
-class _ImmediateEventLoop(eventing.EventLoop):
-    def call_soon(self, callback: Callable[..., None], *args):
-        callback(*args)
+    def close(self):
+        """Closes the HTTP connection, which ends a blocking iteration on another thread."""
+        self._closed = True
+        try:
+            # Closing the response alone does not wake up a thread blocked on reading the socket.
+            self.resp.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        self.resp.close()
 
 
 class MessageEvent:
@@ -79,16 +83,19 @@ _CLOSED = 2
 class EventSource(eventing.EventSource):
     """
     Partially implements https://developer.mozilla.org/en-US/docs/Web/API/EventSource
+    By default listeners are called on the thread reading the stream. Pass an eventing.ThreadPoolEventLoop
+    if listeners may block, for example by doing HTTP requests.
     """
-    def __init__(self, url: str):
-        super().__init__(_ImmediateEventLoop())
+    def __init__(self, url: str, event_loop: eventing.EventLoop = None):
+        super().__init__(event_loop or eventing.ImmediateEventLoop())
         self.url = url
         self.readyState = _CONNECTING
+        self._messages: Optional[SSEClient1] = None
 
     def connect(self):
         """Non-Web/API/EventSource method to defer connection AFTER event listeners have been added."""
         def sse_connect():
-            while True:
+            while self.readyState != _CLOSED:
                 try:
                     messages = SSEClient1(self.url)
                 except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
@@ -96,18 +103,24 @@ class EventSource(eventing.EventSource):
                     self._process_event(Event(data=str(e), event='error'))
                     return
 
+                self._messages = messages
+                if self.readyState == _CLOSED:
+                    messages.close()
+                    return
                 self.readyState = _OPEN
                 try:
                     for event in messages:
-                        if self.readyState == _CLOSED:  # TODO: We should close the underlying HTTP request.
-                            logging.info('EventSource closing...')
-                            return
-
+                        if self.readyState == _CLOSED:
+                            break
                         self._process_event(event)
-                except (ConnectionResetError, requests.exceptions.ConnectionError) as e:
-                    # TODO: We do not need to handle ConnectionError, SSEClient does it for us.
-                    logging.exception(str(e))
-                    pass
+                except (ConnectionResetError, requests.exceptions.ConnectionError, ValueError) as e:
+                    # ValueError is raised when reading from the response closed by close().
+                    if self.readyState != _CLOSED:
+                        logging.exception(str(e))
+
+                if self.readyState == _CLOSED:
+                    logging.info('EventSource closed')
+                    return
 
                 logging.debug('EventSource reconnect...')
                 self.readyState = _CONNECTING
@@ -121,11 +134,15 @@ class EventSource(eventing.EventSource):
         elif not event.event:
             event.event = 'message'
         event.type = event.event  # https://developer.mozilla.org/en-US/docs/Web/API/Event/type
-        logging.debug('EventSource._process_event: ' + event.type)
+        logging.debug('EventSource._process_event: %s', event.type)
         self.dispatch_event(event)
 
     def close(self):
+        """Closes the HTTP connection and ends the reader thread."""
         self.readyState = _CLOSED
+        messages = self._messages
+        if messages is not None:
+            messages.close()
 
     def onopen(self, event: Event):
         raise NotImplementedError('Use add_event_listener("open", ...)')
@@ -0,0 +1,47 @@
+"""
+    compression.py
+
+    Streaming compression of the event stream.
+    Each connection has its own compressor, which is flushed after each write, so that every event reaches the
+    client immediately while the compression context (and thus repeated JSON keys) is shared over the whole stream.
+
+    Note that clients which read the raw stream but still advertise gzip (for example the sseclient package with
+    its default requests headers) must send Accept-Encoding: identity.
+"""
+import zlib
+from typing import Optional
+
+# Supported content codings in order of preference, with their zlib wbits.
+_wbits_by_encoding = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def negotiate(accept_encoding: Optional[str], level: int) -> Optional[str]:
+    """Returns the content coding to use for the Accept-Encoding request header, or None.
+    A level of 0 disables compression."""
+    if not accept_encoding or not level:
+        return None
+    accepted = set()
+    for coding in accept_encoding.lower().split(','):
+        name, _, params = coding.partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    for encoding in _wbits_by_encoding:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+
+    def __init__(self, encoding: str, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, _wbits_by_encoding[encoding])
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses the data so that it can be decompressed by the client without waiting for more data."""
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
@@ -0,0 +1,113 @@
+"""
+    metrics.py
+
+    Low overhead instrumentation of the event streams, exposed by the /stream/metrics endpoint.
+    Recording costs a clock read and a few counter increments per broadcast and per written event.
+    Set enabled to False (or the Flask config sse_metrics) to switch recording off.
+"""
+import bisect
+import threading
+import time
+from typing import Dict, Iterable, List, Sequence, Union
+
+enabled = True
+
+# Bucket upper bounds in seconds, the last bucket counts all larger values.
+_bounds = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Counts observed durations in fixed buckets."""
+
+    def __init__(self, bounds: Sequence[float] = _bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        i = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self.counts)
+            count, sum_ = self.count, self.sum
+        return dict(
+            count=count,
+            mean=sum_ / count if count else None,
+            p50=self._quantile(counts, count, 0.5),
+            p99=self._quantile(counts, count, 0.99),
+            buckets=[dict(le=bound, count=c) for bound, c in zip(self.bounds + ('+Inf',), counts)]
+        )
+
+    def _quantile(self, counts: List[int], count: int, q: float) -> Union[float, str, None]:
+        """The upper bound of the bucket containing the quantile."""
+        if not count:
+            return None
+        cumulative = 0
+        for bound, c in zip(self.bounds, counts):
+            cumulative += c
+            if cumulative >= q * count:
+                return bound
+        return '+Inf'
+
+
+class RateMeter:
+    """Counts events per second over the last window seconds."""
+
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.total = 0
+        self._start = int(time.monotonic())
+        self._seconds = [0] * window
+        self._counts = [0] * window
+
+    def mark(self):
+        # Racing updates may lose a count, which is acceptable for a rate.
+        now = int(time.monotonic())
+        slot = now % self.window
+        if self._seconds[slot] != now:
+            self._seconds[slot] = now
+            self._counts[slot] = 0
+        self._counts[slot] += 1
+        self.total += 1
+
+    def rate(self) -> float:
+        now = int(time.monotonic())
+        # The current second is incomplete, so it is left out.
+        count = sum(c for s, c in zip(self._seconds, self._counts) if 0 < now - s < self.window)
+        return count / min(self.window - 1, max(now - self._start, 1))
+
+
+# Duration of serializing a broadcast event.
+serialization_seconds = Histogram()
+# Duration from enqueueing a broadcast event until it was written to a connection.
+latency_seconds = Histogram()
+_broadcasts_by_topic: Dict[str, RateMeter] = dict()
+
+
+def observe_broadcast(topic: str, seconds: float):
+    meter = _broadcasts_by_topic.get(topic)
+    if meter is None:
+        meter = _broadcasts_by_topic.setdefault(topic, RateMeter())
+    meter.mark()
+    serialization_seconds.observe(seconds)
+
+
+def observe_written(frames: Iterable):
+    """Observes the latency of the written frames, frames without a created time are ignored."""
+    now = time.monotonic()
+    for frame in frames:
+        if frame.created:
+            latency_seconds.observe(now - frame.created)
+
+
+def broadcasts() -> List[dict]:
+    return [dict(topic=topic, total=meter.total, perSecond=meter.rate())
+            for topic, meter in list(_broadcasts_by_topic.items())]
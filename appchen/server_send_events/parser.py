@@ -0,0 +1,108 @@
+"""
+    parser.py
+
+    Incremental parser of the text/event-stream format, see
+    https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+
+    The parser works on bytes. Each received byte is scanned once for line ends, independent of how the stream is
+    split into chunks, and the data lines of an event are decoded from UTF-8 in one go when the event is dispatched.
+    Used by both the client and the aioclient module.
+"""
+import re
+from typing import List, Optional
+
+from appchen import eventing
+
+_line_end = re.compile(rb'\r\n|\r|\n')
+
+
+class Event(eventing.Event):
+    """A server send event, with the same attributes as sseclient.Event plus the Web/API type."""
+
+    def __init__(self, data: str = '', event: str = 'message', id: Optional[str] = None, retry: Optional[int] = None):
+        self.data = data
+        self.event = event
+        self.type = event
+        self.id = id
+        self.retry = retry
+
+    def __repr__(self):
+        return f'Event(event={self.event!r}, id={self.id!r}, data={self.data[:80]!r})'
+
+
+class EventStreamParser:
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # Position in the buffer from which to search for the next line end.
+        self._scan_from = 0
+        # Whether the last line ended with a CR at the end of the buffer, so that a leading LF must be skipped.
+        self._skip_lf = False
+        # The last event id is not reset when an event is dispatched.
+        self._id: Optional[str] = None
+        self._reset_event()
+
+    def _reset_event(self):
+        self._data: List[bytes] = []
+        self._event: Optional[bytes] = None
+        self._retry: Optional[int] = None
+
+    def reset(self):
+        """Discards any partially received event, for example after a reconnect.
+        The last event id is kept as the spec demands."""
+        self._buffer.clear()
+        self._scan_from = 0
+        self._skip_lf = False
+        self._reset_event()
+
+    def feed(self, chunk: bytes) -> List[Event]:
+        """Returns all events completed by the chunk."""
+        buffer = self._buffer
+        if self._skip_lf and chunk:
+            self._skip_lf = False
+            if chunk[:1] == b'\n':
+                chunk = chunk[1:]
+        buffer += chunk
+
+        events = []
+        start = 0  # Start of the current line
+        search = _line_end.search
+        match = search(buffer, self._scan_from)
+        while match is not None:
+            end, next_start = match.span()
+            if next_start == len(buffer) and next_start - end == 1 and buffer[end] == 0x0D:
+                self._skip_lf = True  # A lone CR, a LF may follow in the next chunk.
+            self._process_line(bytes(buffer[start:end]), events)
+            start = next_start
+            match = search(buffer, start)
+
+        del buffer[:start]
+        self._scan_from = len(buffer)
+        return events
+
+    def _process_line(self, line: bytes, events: List[Event]):
+        if not line:
+            if self._data:
+                events.append(Event(
+                    b'\n'.join(self._data).decode('utf-8', 'replace'),
+                    self._event.decode('utf-8', 'replace') if self._event else 'message',
+                    self._id,
+                    self._retry))
+            self._reset_event()
+            return
+
+        name, colon, value = line.partition(b':')
+        if not name:
+            return  # Comment, for example a keep alive
+        if colon and value[:1] == b' ':
+            value = value[1:]
+        if name == b'data':
+            self._data.append(value)
+        elif name == b'event':
+            self._event = value
+        elif name == b'id':
+            if b'\0' not in value:
+                self._id = value.decode('utf-8', 'replace')
+        elif name == b'retry':
+            if value.isdigit():
+                self._retry = int(value)
@@ -0,0 +1,172 @@
+"""
+    queues.py
+
+    The per connection queue of pending events.
+    A queue may be bounded, so that a slow consumer (for example a stalled browser tab behind a slow proxy)
+    cannot accumulate events until the server runs out of memory.
+    What happens to an event which does not fit into the queue is decided by the OverflowPolicy.
+
+    Events of conflated topics (typically full state snapshots) are delivered latest-value-only:
+    At most one undelivered event per conflated topic is pending, a newer event replaces it in place.
+"""
+import collections
+import enum
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class OverflowPolicy(enum.Enum):
+    # Discard the oldest pending event to make room for the new one.
+    DROP_OLDEST = 'drop_oldest'
+    # Discard the new event.
+    DROP_NEWEST = 'drop_newest'
+    # Discard all pending events and close the queue. The client is expected to reconnect.
+    DISCONNECT = 'disconnect'
+
+
+class QueueClosed(Exception):
+    """Raised by EventQueue.get() when the queue is closed and drained."""
+
+
+# Total number of dropped events by topic, over all connections.
+dropped_events = collections.Counter()
+_dropped_events_lock = threading.Lock()
+
+
+class _Latest:
+    """Placeholder in the queue for the latest pending event of a conflated topic."""
+    __slots__ = ('item',)
+
+    def __init__(self, item):
+        self.item = item
+
+
+def _unwrap(item):
+    return item.item if type(item) is _Latest else item
+
+
+class EventQueue:
+    """
+    A thread safe FIFO queue of events (frames).
+    A maxsize of 0 means unbounded.
+    Items with a true `conflate` attribute are conflated by their `topic` attribute.
+    """
+
+    def __init__(self, maxsize: int = 0, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.conflated = 0
+        self.closed = False
+        self.overflowed = False
+        self._items = collections.deque()
+        self._latest_by_topic: Dict[str, _Latest] = dict()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def put(self, item) -> bool:
+        """Enqueues the item and returns True, or returns False if the item was dropped."""
+        with self._lock:
+            if self.closed:
+                return False
+            if getattr(item, 'conflate', False):
+                latest = self._latest_by_topic.get(item.topic)
+                if latest is not None:
+                    latest.item = item
+                    self.conflated += 1
+                    return True
+            if self.maxsize and len(self._items) >= self.maxsize:
+                if self.policy is OverflowPolicy.DROP_NEWEST:
+                    self._drop(item)
+                    return False
+                if self.policy is OverflowPolicy.DROP_OLDEST:
+                    self._drop(self._popleft())
+                else:
+                    for pending in self._items:
+                        self._drop(_unwrap(pending))
+                    self._drop(item)
+                    self._items.clear()
+                    self._latest_by_topic.clear()
+                    self.overflowed = True
+                    self.closed = True
+                    self._wakeup()
+                    return False
+            if getattr(item, 'conflate', False):
+                self._latest_by_topic[item.topic] = item = _Latest(item)
+            self._items.append(item)
+            if len(self._items) == 1:
+                self._wakeup()
+            return True
+
+    def close(self):
+        """Closes the queue. Pending items can still be retrieved."""
+        with self._lock:
+            self.closed = True
+            self._wakeup()
+
+    def get(self, timeout: Optional[float] = None):
+        """
+        Removes and returns the oldest item, blocking at most timeout seconds.
+        Raises QueueClosed if the queue is closed and empty, and TimeoutError if the timeout expired.
+        """
+        with self._lock:
+            if not self._items and not self.closed:
+                self._not_empty.wait_for(lambda: self._items or self.closed, timeout)
+            return self._pop()
+
+    def get_batch(self, max_bytes: int, max_delay: float = 0.0) -> List:
+        """
+        Blocks until an item is available, then removes and returns all pending items up to a total size of
+        max_bytes (measured by the length of the `data` attribute of the items).
+        If fewer bytes are pending, waits at most max_delay seconds for more items.
+        Raises QueueClosed if the queue is closed and empty.
+        """
+        with self._lock:
+            if not self._items and not self.closed:
+                self._not_empty.wait_for(lambda: self._items or self.closed)
+            batch = [self._pop()]
+            size = self._drain(batch, len(batch[0].data), max_bytes)
+            if size < max_bytes and max_delay > 0:
+                deadline = time.monotonic() + max_delay
+                while size < max_bytes and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._not_empty.wait_for(lambda: self._items or self.closed, remaining):
+                        break
+                    size = self._drain(batch, size, max_bytes)
+            return batch
+
+    def _drain(self, batch: List, size: int, max_bytes: int) -> int:
+        """Must be called with the lock held. Moves pending items to the batch and returns the batch size."""
+        while self._items and size < max_bytes:
+            item = self._popleft()
+            batch.append(item)
+            size += len(item.data)
+        return size
+
+    def _pop(self):
+        """Must be called with the lock held."""
+        if self._items:
+            return self._popleft()
+        if self.closed:
+            raise QueueClosed()
+        raise TimeoutError()
+
+    def _popleft(self):
+        item = self._items.popleft()
+        if type(item) is _Latest:
+            del self._latest_by_topic[item.item.topic]
+            return item.item
+        return item
+
+    def _wakeup(self):
+        """Called with the lock held whenever the queue becomes non-empty or is closed."""
+        self._not_empty.notify()
+
+    def _drop(self, item):
+        self.dropped += 1
+        with _dropped_events_lock:
+            dropped_events[getattr(item, 'topic', None)] += 1
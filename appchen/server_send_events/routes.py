@@ -1,55 +1,157 @@
 # Copyright 2020 Wolfgang Kühn
 #
 
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
-from typing import List, Callable, Dict
-from flask import Response, request, jsonify, Blueprint
+from typing import List, Dict, Iterable, Optional
+from flask import Response, request, Blueprint
 
-from appchen.server_send_events import server
+from appchen.serialization import json_response
+from appchen.server_send_events import compression, metrics, server
+from appchen.server_send_events.queues import OverflowPolicy
+from appchen.server_send_events.state_cache import StateCache
 
-_state_events_by_topic: Dict[str, Callable[[], dict]] = dict()
+_state_events_by_topic: Dict[str, StateCache] = dict()
+# Bounded pool on which state snapshots are computed, several snapshots requested at once are computed concurrently.
+_snapshot_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='snapshot')
 
 # TODO: A note on static folder!
 app = Blueprint('appchen', __name__)
 
 
-def route(topic: str, **kwargs):
+@app.record
+def configure(state):
+    """Reads the optional settings sse_<name> from the Flask config, where <name> is one of the module variables
+    queue_maxsize, overflow_policy, replay_size, heartbeat_interval, batch_max_bytes, batch_max_delay,
+    compression_level of the server module, or snapshot_workers, bus or metrics (to switch off recording)."""
+    global _snapshot_executor
+    config = state.app.config
+    if 'sse_snapshot_workers' in config:
+        _snapshot_executor = ThreadPoolExecutor(max_workers=config['sse_snapshot_workers'],
+                                                thread_name_prefix='snapshot')
+    if 'sse_bus' in config:
+        server.set_bus(config['sse_bus'])
+    for name in ('queue_maxsize', 'replay_size', 'heartbeat_interval', 'batch_max_bytes', 'batch_max_delay',
+                 'compression_level'):
+        setattr(server, name, config.get('sse_' + name, getattr(server, name)))
+    metrics.enabled = config.get('sse_metrics', metrics.enabled)
+    server.overflow_policy = OverflowPolicy(config.get('sse_overflow_policy', server.overflow_policy))
+
+
+def route(topic: str, cache_ttl: Optional[float] = 0, invalidated_by: Iterable[str] = (), **kwargs):
     """A decorator used to register a state event.
+    The encoded state is cached for cache_ttl seconds (None means forever) and until an event is broadcast on one of
+    the invalidated_by topics. Concurrent subscribers always share one computation, even if nothing is cached.
     """
 
     def decorator(f):
         if topic in _state_events_by_topic:
             raise KeyError('Topic is already routed: ' + topic)
-        _state_events_by_topic[topic] = partial(f, **kwargs)
+        if topic not in server.declared_topics:
+            # Declared topics have a replay buffer, so that connections subscribed to the state can be resumed.
+            server.declare_topic(topic, (f.__doc__ or '').strip())
+        cache = StateCache(topic, partial(f, **kwargs), cache_ttl)
+        for invalidating_topic in invalidated_by:
+            server.add_broadcast_listener(invalidating_topic, cache.invalidate)
+        _state_events_by_topic[topic] = cache
         return f
 
     return decorator
 
 
+def subscribe(connection: server.Connection, topics: List[str]) -> List[Future]:
+    """Subscribes the connection to the topics.
+    For routed state topics, the current state is computed on the snapshot pool and emitted as soon as it is ready,
+    and only then is the connection subscribed to that topic. So no update is ever received before its snapshot.
+    On the first subscribe of a resumed connection, all topics are resumed instead if possible, otherwise none is.
+    The other topics are subscribed after all snapshots of the call are emitted.
+    Returns the futures of the pending snapshots and subscriptions.
+    This is shared by all engines, see post_subscribe(), open_connection() and the asgi module.
+    """
+    if not topics:
+        return []  # Keeps the resume state for the first subscribe with topics.
+    resume_sequence, connection.resume_sequence = connection.resume_sequence, None
+    if resume_sequence is not None and server.resume(connection, topics, resume_sequence):
+        return []
+    immediate_topics = []
+    futures = []
+    for topic in topics:
+        if topic.endswith('_state') and topic in _state_events_by_topic:
+            futures.append(_snapshot_executor.submit(_emit_snapshot, connection, topic))
+        else:
+            immediate_topics.append(topic)
+
+    if not futures:
+        server.subscribe(connection, immediate_topics)
+        return futures
+    # The other topics may carry the updates of the states, so they are subscribed after all snapshots are emitted.
+    subscribed = Future()
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def on_snapshot_done(_future: Future):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        server.subscribe(connection, immediate_topics)
+        subscribed.set_result(None)
+
+    for future in futures:
+        future.add_done_callback(on_snapshot_done)
+    return futures + [subscribed]
+
+
+def _emit_snapshot(connection: server.Connection, topic: str):
+    frame = _state_events_by_topic[topic].get()
+    if frame:
+        connection.queue.put(frame)
+    server.subscribe(connection, [topic])
+
+
+def log_snapshot_error(future: Future):
+    if future.exception() is not None:
+        logging.error('Snapshot failed', exc_info=future.exception())
+
+
 @app.route('/stream/subscribe', methods=['POST'])
 def post_subscribe():
     request_data: dict = request.get_json(force=True)
     connection_id: str = request_data['connectionId']
     topics: List[str] = request_data['topics']
     connection = server.get_connection_by_id(connection_id)
-    for topic in topics:
-        if topic.endswith('_state') and topic in _state_events_by_topic:
-            evt = _state_events_by_topic[topic]()
-            if evt:
-                connection.emit(topic, evt)
-
-    server.subscribe(connection, topics)
-    return jsonify('Done')
+    if connection is None:
+        return json_response(dict(error='Connection not found'), 404)
+    for future in subscribe(connection, topics):
+        future.result()
+    return json_response('Done')
 
 
 @app.route('/stream/connection', methods=['GET'])
 def open_connection():
-    connection = server.Connection()
-    server.register(connection, 'keep_alive_or_let_die')
-    connection.emit('connection_open', dict(connectionId=connection.id))
-    return Response(connection.event_generator(), mimetype="text/event-stream")
+    """Opens the event stream. The optional query parameter topics is a comma separated list of topics to which the
+    connection is subscribed right away, saving the round trip of a separate subscribe request."""
+    topics = [topic for topic in request.args.get('topics', '').split(',') if topic]
+    # Browsers send the Last-Event-ID header when reconnecting, polyfills may use a query parameter instead.
+    connection = server.Connection(last_event_id=request.headers.get('Last-Event-ID', request.args.get('lastEventId')))
+    connection.emit('connection_open', dict(connectionId=connection.id, topics=topics))
+    if topics:
+        for future in subscribe(connection, topics):
+            future.add_done_callback(log_snapshot_error)
+    content_encoding = compression.negotiate(request.headers.get('Accept-Encoding'), server.compression_level)
+    headers = {'Content-Encoding': content_encoding, 'Vary': 'Accept-Encoding'} if content_encoding else None
+    return Response(connection.event_generator(content_encoding), mimetype="text/event-stream", headers=headers)
 
 
 @app.route('/stream/topics', methods=['GET'])
 def get_topics():
-    return jsonify(list(server.declared_topics.values()))
+    return json_response(list(server.declared_topics.values()))
+
+
+@app.route('/stream/metrics', methods=['GET'])
+def get_metrics():
+    """The metrics of the streams, see server.metrics_snapshot(). The query parameter connections limits the number
+    of listed connection queues, default 100."""
+    return json_response(server.metrics_snapshot(request.args.get('connections', 100, type=int)))
@@ -7,68 +7,261 @@
     Events can be broadcast to all registered Connections.
     Events can also be emitted to a single Connection.
 
+    Broadcast events carry an id. A client reconnecting with a Last-Event-ID header can be resumed,
+    i.e. it receives only the events it missed, as long as they are still in the replay buffer of the topic.
+
     Usage see routes.py
 """
 import threading
-import time
+import itertools
 import collections
-import json
+import time
+import re
 import logging
 import secrets
-import datetime
 import types
-from queue import Queue
-from typing import List, Dict, Optional, Callable, Union
+from typing import List, Dict, Optional, Callable, Union, Set, Tuple, Iterable, NamedTuple
+
+from appchen import serialization
+from appchen.server_send_events import metrics, queues
+from appchen.server_send_events.bus import Bus, LocalBus
+from appchen.server_send_events.compression import StreamCompressor
+from appchen.server_send_events.queues import EventQueue, OverflowPolicy, QueueClosed
 
-_connections = collections.deque()
-_connections_by_event_type = collections.defaultdict(set)
 declared_topics: Dict[str, dict] = dict()
-_keep_alive_thread: threading.Thread = None
+# Bound and overflow policy of the queue of each new connection, a bound of 0 means unbounded.
+queue_maxsize: int = 1000
+overflow_policy: OverflowPolicy = OverflowPolicy.DISCONNECT
+_conflation_by_topic: Dict[str, bool] = dict()
+# Number of broadcast events kept per topic for resuming clients.
+replay_size: int = 100
+_replay_by_topic: Dict[str, 'ReplayBuffer'] = dict()
+# Event ids are <epoch>-<sequence>. The epoch changes with each server process, so that ids issued by a previous
+# process are never resumed.
+_epoch = secrets.token_hex(4)
+_sequence = itertools.count(1)
+# Held while a broadcast event is sequenced and enqueued, see _fan_out().
+_fan_out_lock = threading.Lock()
+_broadcast_listeners_by_topic: Dict[str, List[Callable[[], None]]] = dict()
+bus: Bus = LocalBus()
+# All pending events of a connection up to this size are written at once. If fewer are pending, wait at most
+# batch_max_delay seconds for more, trading latency for fewer writes.
+batch_max_bytes: int = 64 * 1024
+batch_max_delay: float = 0.0
+# zlib compression level of the event stream if the client accepts gzip or deflate, 0 disables compression.
+compression_level: int = 6
+# Seconds of inactivity after which a connection receives a keep alive comment, see Heartbeat.
+heartbeat_interval: float = 10.0
 # _event_cache_by_topic: Dict[str, str] = {}
 
+
+class ConnectionRegistry:
+    """
+    Keeps track of all open connections and the topics they are subscribed to.
+    Lookup by id, subscribe, unsubscribe and remove are O(1) per topic.
+    All methods are thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections_by_id: Dict[str, 'Connection'] = dict()
+        self._connections_by_topic: Dict[str, Set['Connection']] = dict()
+        # Reverse index, note that the connection is hashed by its id(), not by its id attribute.
+        self._topics_by_connection: Dict['Connection', Set[str]] = dict()
+
+    def __len__(self) -> int:
+        return len(self._connections_by_id)
+
+    def add(self, connection: 'Connection'):
+        with self._lock:
+            self._connections_by_id[connection.id] = connection
+            self._topics_by_connection[connection] = set()
+
+    def remove(self, connection: 'Connection'):
+        with self._lock:
+            self._connections_by_id.pop(connection.id, None)
+            for topic in self._topics_by_connection.pop(connection, ()):
+                connections = self._connections_by_topic[topic]
+                connections.discard(connection)
+                if not connections:
+                    del self._connections_by_topic[topic]
+
+    def get(self, connection_id: str) -> Optional['Connection']:
+        return self._connections_by_id.get(connection_id)
+
+    def subscribe(self, connection: 'Connection', topics: Iterable[str]):
+        with self._lock:
+            subscribed_topics = self._topics_by_connection.get(connection)
+            if subscribed_topics is None:
+                return  # Connection was already removed.
+            for topic in topics:
+                subscribed_topics.add(topic)
+                self._connections_by_topic.setdefault(topic, set()).add(connection)
+
+    def unsubscribe(self, connection: 'Connection', topics: Iterable[str]):
+        with self._lock:
+            subscribed_topics = self._topics_by_connection.get(connection, set())
+            for topic in topics:
+                if topic not in subscribed_topics:
+                    continue
+                subscribed_topics.remove(topic)
+                connections = self._connections_by_topic[topic]
+                connections.remove(connection)
+                if not connections:
+                    del self._connections_by_topic[topic]
+
+    def subscribers(self, topic: str) -> Tuple['Connection', ...]:
+        """Returns a snapshot of the connections subscribed to the topic, safe to iterate without holding the lock."""
+        with self._lock:
+            connections = self._connections_by_topic.get(topic)
+            return tuple(connections) if connections else ()
+
+    def connections(self) -> Tuple['Connection', ...]:
+        with self._lock:
+            return tuple(self._connections_by_id.values())
+
+    def topics(self) -> List[str]:
+        with self._lock:
+            return list(self._connections_by_topic)
+
+
+registry = ConnectionRegistry()
+
+
+class ReplayBuffer:
+    """The most recent broadcast frames of a topic."""
+
+    def __init__(self, maxlen: int):
+        # Held while appending a frame and fanning it out, and while resuming a connection.
+        self.lock = threading.Lock()
+        self._frames = collections.deque(maxlen=maxlen)
+        # All frames with a sequence greater than the floor are in the buffer.
+        self.floor = next(_sequence)
+
+    def append(self, frame: 'Frame'):
+        if len(self._frames) == self._frames.maxlen:
+            self.floor = self._frames[0].sequence
+        self._frames.append(frame)
+
+    def since(self, sequence: int) -> Optional[List['Frame']]:
+        """Returns the frames after the specified sequence, or None if some of them are no longer known."""
+        if sequence < self.floor:
+            return None
+        return [frame for frame in self._frames if frame.sequence > sequence]
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[int]:
+    """Returns the sequence of an event id issued by this process, or None."""
+    epoch, _, sequence = (event_id or '').partition('-')
+    if epoch != _epoch or not sequence.isdigit():
+        return None
+    return int(sequence)
+
+
+class Frame(NamedTuple):
+    """An encoded event. A broadcast frame is shared by reference between all receiving connections."""
+    topic: str
+    data: bytes
+    # Whether only the latest pending frame of the topic is delivered, see queues.EventQueue.
+    conflate: bool = False
+    # Sequence part of the event id, 0 for frames without an id.
+    sequence: int = 0
+    # Monotonic time at which a broadcast frame was enqueued, 0 if not measured, see metrics.
+    created: float = 0.0
+
+
+_line_break = re.compile(r'\r\n|\r|\n')
+
+
+def encode_event(event_type: str, data: str, sequence: int = 0, created: float = 0.0) -> Frame:
+    """Encodes the event in SSE syntax, see https://html.spec.whatwg.org/multipage/server-sent-events.html"""
+    if '\n' in data or '\r' in data:
+        # Each line goes into its own data field, the client joins them with a LF.
+        data = '\ndata: '.join(_line_break.split(data))
+    text = f'event: {event_type}\ndata: {data}\n\n'
+    if sequence:
+        text = f'id: {_epoch}-{sequence}\n' + text
+    return Frame(event_type, text.encode(), is_conflated(event_type), sequence, created)
+
+
+def join_frames(frames: List[Frame]) -> bytes:
+    """The data of the frames, to be written at once."""
+    return frames[0].data if len(frames) == 1 else b''.join(frame.data for frame in frames)
+
+
+def conflate_topic(topic: str, conflate: bool = True):
+    """
+    Sets the delivery mode of the topic.
+    If conflated, a connection which falls behind only receives the latest of the pending events of that topic.
+    By default, topics ending in _state are conflated, because their events are full snapshots.
+    """
+    _conflation_by_topic[topic] = conflate
+
+
+def is_conflated(topic: str) -> bool:
+    conflate = _conflation_by_topic.get(topic)
+    return topic.endswith('_state') if conflate is None else conflate
+
+
 class Connection:
     """A Connection represents the HTTP connection initiated by a client (Browser) over which the events are send."""
 
-    def __init__(self):
-        self.queue = Queue()
+    def __init__(self, queue: EventQueue = None, last_event_id: str = None):
+        # See the asgi module for an asyncio based queue.
+        self.queue = EventQueue(queue_maxsize, overflow_policy) if queue is None else queue
         self.id: str = secrets.token_hex(10)
-        _connections.append(self)
+        # Monotonic time at which the last frame was handed to the HTTP server, see Heartbeat.
+        self.last_write = time.monotonic()
+        # The sequence of the last event the client received on a previous connection, see resume().
+        self.resume_sequence: Optional[int] = parse_event_id(last_event_id)
+        registry.add(self)
+        heartbeat.ensure_started()
 
     def remove(self):
-        _connections.remove(self)
-        for event_type in _connections_by_event_type:
-            try:
-                _connections_by_event_type[event_type].remove(self)
-            except:
-                pass
-
-    def event_generator(self):
+        registry.remove(self)
+
+    def event_generator(self, content_encoding: str = None):
+        """Yields the events as chunks of bytes, compressed with the content coding if specified."""
+        compress = StreamCompressor(content_encoding, compression_level).compress if content_encoding else bytes
         try:
             while True:
-                event_type, data = self.queue.get()
-                self.queue.task_done()  # We do not need this
-                # TODO: this assumes that date is single line!!!
-                yield f'event: {event_type}\ndata: {data}\n\n'  # This is SSE syntax
-        except GeneratorExit as e:
-            print(repr(e))
+                frames: List[Frame] = self.queue.get_batch(batch_max_bytes, batch_max_delay)
+                self.last_write = time.monotonic()
+                yield compress(join_frames(frames))
+                # The HTTP server asks for the next chunk after it has written this one.
+                if metrics.enabled:
+                    metrics.observe_written(frames)
+        except QueueClosed:
+            if self.queue.overflowed:
+                yield compress(self.overflow_frame().data)
+        except GeneratorExit:
+            logging.debug('Connection %s closed by the client', self.id)
+        finally:
             self.remove()
 
+    def overflow_frame(self) -> Frame:
+        """The last event send to a client which could not keep up with the events."""
+        logging.warning('Disconnecting slow consumer %s, %s events dropped', self.id, self.queue.dropped)
+        return encode_event('connection_error', serialization.dumps(dict(
+            connectionId=self.id, reason='Slow consumer', dropped=self.queue.dropped)))
+
     def emit(self, event_type: str, event: dict):
         """Emit the event to this connection only."""
-        data = json.dumps(event)
-        logging.debug(f'emit {event_type}')
-        self.queue.put((event_type, data))
+        frame = encode_event(event_type, serialization.dumps(event))
+        logging.debug('emit %s', event_type)
+        self.queue.put(frame)
 
 
 def register(connection: Connection, event_type: str):
     """
     Registers a connection to receive a specific event type.
     Multiple registrations with the same event type are condensed into one.
+    Replay buffers are created here for declared topics only, other topics get one on their first broadcast,
+    so that clients cannot allocate buffers by subscribing to arbitrary names.
     """
-    # Note that the connection is hashed by its id(), not by its id attribute.
-    _connections_by_event_type[event_type].add(connection)
-    if _keep_alive_thread is None or not _keep_alive_thread.is_alive():
-        pump_keep_alive_or_let_die()
+    if event_type not in _replay_by_topic and event_type in declared_topics:
+        _replay_by_topic.setdefault(event_type, ReplayBuffer(replay_size))
+    registry.subscribe(connection, (event_type,))
 
 
 def subscribe(connection: Connection, event_types: List[str]):
@@ -80,57 +273,182 @@ def subscribe(connection: Connection, event_types: List[str]):
         #     connection.queue.put((event_type, _event_cache_by_topic[event_type]))
 
 
+def resume(connection: Connection, topics: Iterable[str], sequence: int) -> bool:
+    """
+    Subscribes the connection to the topics and replays all events of the topics after the specified sequence.
+    Either all topics are resumed or none, because a state is only consistent with all of its deltas:
+    Returns False without subscribing if some of these events are no longer known.
+    """
+    topics = sorted(set(topics))
+    replays = [_replay_by_topic.get(topic) for topic in topics]
+    if not topics or None in replays:
+        return False
+    # Locked in the order of the topics, so that concurrent resumes cannot deadlock.
+    for replay in replays:
+        replay.lock.acquire()
+    try:
+        missed_by_topic = [replay.since(sequence) for replay in replays]
+        if None in missed_by_topic:
+            return False
+        for topic in topics:
+            register(connection, topic)
+        missed = sorted((frame for frames in missed_by_topic for frame in frames), key=lambda frame: frame.sequence)
+        for frame in missed:
+            connection.queue.put(frame)
+    finally:
+        for replay in replays:
+            replay.lock.release()
+    logging.debug('resume %s with %s events', topics, len(missed))
+    return True
+
+
+def unsubscribe(connection: Connection, event_types: List[str]):
+    registry.unsubscribe(connection, event_types)
+
+
 def get_connection_by_id(guid: str) -> Optional[Connection]:
     """Returns the specified connection"""
-    for connection in _connections:
-        if connection.id == guid:
-            return connection
-    return None
+    return registry.get(guid)
 
 
 def broadcast(topic: str, event: Union[Callable[[], Dict], Dict]):
     """
-    Broadcasts the event to all registered Connections.
-    The event must be serializable by json.dumps()
+    Broadcasts the event to all registered Connections, in all server processes reached by the bus.
+    The event must be serializable by serialization.dumps()
     """
-    if topic not in _connections_by_event_type:
-        return
+    if (bus.local and topic not in _replay_by_topic and topic not in _broadcast_listeners_by_topic
+            and not registry.subscribers(topic)):
+        return  # Nobody ever subscribed.
 
     if isinstance(event, types.FunctionType):
         event = event()
-    data = json.dumps(event)
-    logging.debug(f'broadcast {topic}')
+    if metrics.enabled:
+        start = time.perf_counter()
+        data = serialization.dumps(event)
+        metrics.observe_broadcast(topic, time.perf_counter() - start)
+    else:
+        data = serialization.dumps(event)
+    bus.publish(topic, data)
+
+
+def _fan_out(topic: str, data: str):
+    """Delivers a serialized broadcast event to the connections of this process."""
+    for listener in _broadcast_listeners_by_topic.get(topic, ()):
+        listener()
+
+    replay = _replay_by_topic.get(topic)
+    if replay is None:
+        if not registry.subscribers(topic):
+            return  # Nobody ever subscribed.
+        replay = _replay_by_topic.setdefault(topic, ReplayBuffer(replay_size))
+
+    # Sequences are assigned and enqueued under one lock for all topics, so that every connection receives them in
+    # increasing order, which resume() relies on. Enqueueing never blocks.
+    with _fan_out_lock, replay.lock:
+        frame = encode_event(topic, data, next(_sequence), time.monotonic() if metrics.enabled else 0.0)
+        replay.append(frame)
+        for connection in registry.subscribers(topic):
+            connection.queue.put(frame)
+    logging.debug('broadcast %s', topic)
     # if topic not in declared_topics:
     #     declared_topics[topic] = dict(topic=topic, description='TODO', example=event)
     # if declared_topics[topic]['example'] is None:
     #     declared_topics[topic]['example'] = event
 
-    for connection in _connections_by_event_type[topic]:
-        connection.queue.put((topic, data))
+
+def set_bus(new_bus: Bus):
+    """Replaces the fan-out backend of broadcast(), see the bus module."""
+    global bus
+    bus.close()
+    new_bus.start(_fan_out)
+    bus = new_bus
+
+
+def add_broadcast_listener(topic: str, listener: Callable[[], None]):
+    """Registers a function called on each broadcast on the topic, whether there are subscribers or not."""
+    _broadcast_listeners_by_topic.setdefault(topic, []).append(listener)
+
+
+def metrics_snapshot(max_connections: int = 100) -> dict:
+    """The current metrics of the streams, with the max_connections connections having the most queued events."""
+    connections = sorted(registry.connections(), key=lambda c: c.queue.qsize(), reverse=True)
+    return dict(
+        connections=len(connections),
+        queued=sum(connection.queue.qsize() for connection in connections),
+        topics=[dict(topic=topic, subscribers=len(registry.subscribers(topic))) for topic in registry.topics()],
+        broadcasts=metrics.broadcasts(),
+        # Events dropped by overflowing queues since start, by topic.
+        dropped=dict(queues.dropped_events),
+        # Events not sent to other server processes since start, by topic, see Bus.dropped.
+        busDropped=dict(bus.dropped),
+        queues=[dict(connectionId=c.id, queued=c.queue.qsize(), dropped=c.queue.dropped, conflated=c.queue.conflated)
+                for c in connections[:max_connections]],
+        serializationSeconds=metrics.serialization_seconds.snapshot(),
+        latencySeconds=metrics.latency_seconds.snapshot(),
+    )
 
 
 def declare_topic(topic: str, description: str, example: dict = None):
     declared_topics[topic] = dict(topic=topic, description=description, example=example)
 
 
-def pump_keep_alive_or_let_die():
-    global _keep_alive_thread
+# An SSE comment, ignored by clients.
+_keep_alive_frame = Frame('keep_alive_or_let_die', b': keep_alive_or_let_die\n\n')
+
+
+class Heartbeat:
+    """
+    Sends a keep alive comment to each connection which was idle for the heartbeat interval.
+    Needed to (1) prevent HTTP proxy timeouts and (2) detect closed connections via GeneratorExit.
+    Busy connections do not receive keep alives.
+    A connection which has pending events but did not write anything for three intervals is considered dead,
+    its queue is closed and it is removed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.beat())
+
+    def beat(self) -> float:
+        """Checks all connections once and returns the number of seconds until the next check is due."""
+        interval = heartbeat_interval
+        now = time.monotonic()
+        next_due = now + interval
+        for connection in registry.connections():
+            idle = now - connection.last_write
+            if connection.queue.qsize():
+                if idle >= 3 * interval:
+                    logging.warning('Removing dead connection %s, idle for %.0fs', connection.id, idle)
+                    connection.queue.close()
+                    connection.remove()
+            elif idle >= interval:
+                connection.queue.put(_keep_alive_frame)
+                # Do not wait for the write, otherwise we would send a burst of keep alives.
+                connection.last_write = now
+            else:
+                next_due = min(next_due, connection.last_write + interval)
+        return max(next_due - now, interval / 10)
 
-    def target():
-        while len(_connections_by_event_type):
-            time.sleep(10)
-            broadcast('keep_alive_or_let_die', dict(
-                datetime=datetime.datetime.utcnow().isoformat() + 'Z',
-                threadCount=threading.active_count()))
 
-    _keep_alive_thread = threading.Thread(target=target)
-    _keep_alive_thread.start()
+heartbeat = Heartbeat()
+bus.start(_fan_out)
 
 
-declare_topic('keep_alive_or_let_die',
-              """Event send each 10 seconds on each connection without explicitly subscribing to it.
-Needed to (1) prevent HTTP proxy timeouts and (2) needed to detect closed connections via GeneratorExit.""",
+declare_topic('connection_error',
+              """Last event send on a connection before the server closes it, for example because the client could not
+keep up with the events. The client should reconnect.""",
               {
-                  "threadCount": 7,
-                  "datetime": "2020-02-29T13:00:00Z"
+                  "connectionId": "3f9a5c0e1d2b4a6f8e7d",
+                  "reason": "Slow consumer",
+                  "dropped": 1001
               })
@@ -0,0 +1,183 @@
+"""
+    shared.py
+
+    Multiplexes the subscribers of a process over one event stream per server.
+    Subscriptions are collected for subscribe_delay seconds and then sent with a single request, the first batch as
+    the topics query parameter of the connection itself. Events are routed to the subscribers locally.
+
+    Usage:
+        subscriber = shared.get_stream('http://localhost:8080/@appchen/web_client/stream/').subscriber()
+
+        @subscriber.route('zen')
+        def on_zen(event):
+            print(event.data)
+
+        subscriber.subscribe()
+        ...
+        subscriber.close()
+
+    The server has no unsubscribe endpoint, so topics without subscribers remain subscribed and their events are
+    dropped locally.
+"""
+import json
+import logging
+import threading
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import requests
+
+from appchen import eventing
+from appchen.server_send_events import client
+from appchen.server_send_events.parser import Event
+
+# Seconds to wait for further subscriptions before sending them in one request.
+subscribe_delay = 0.05
+# Seconds to wait before connecting again after the stream could not be opened.
+reconnect_delay = 3.0
+
+_streams_by_url: Dict[str, 'SharedStream'] = dict()
+_streams_lock = threading.Lock()
+
+
+def get_stream(base_url: str) -> 'SharedStream':
+    """Returns the stream of this process for the base URL of the stream endpoints, which ends with /stream/."""
+    with _streams_lock:
+        stream = _streams_by_url.get(base_url)
+        if stream is None:
+            stream = _streams_by_url[base_url] = SharedStream(base_url)
+        return stream
+
+
+class Subscriber(eventing.EventSource):
+    """A logical subscriber of a shared stream, with the listener API of client.EventSource."""
+
+    def __init__(self, stream: 'SharedStream', event_loop: eventing.EventLoop):
+        super().__init__(event_loop)
+        self.stream = stream
+
+    def subscribe(self, topics: Iterable[str] = None):
+        """Subscribes to the topics, by default to all topics with listeners."""
+        self.stream.subscribe(self, self._event_listeners_by_type if topics is None else topics)
+
+    def close(self):
+        self.stream.remove(self)
+
+
+class _MultiplexedEventSource(client.EventSource):
+
+    def __init__(self, url: str, stream: 'SharedStream'):
+        super().__init__(url)
+        self._stream = stream
+
+    def dispatch_event(self, event: Event):
+        self._stream.route(self, event)
+
+
+class SharedStream:
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.connection_id: Optional[str] = None
+        self._event_source: Optional[_MultiplexedEventSource] = None
+        # The tuples are replaced, not modified, so that the reader thread can route without locking.
+        self._subscribers_by_topic: Dict[str, Tuple[Subscriber, ...]] = dict()
+        # Topics not yet subscribed on the server.
+        self._pending: Set[str] = set()
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def subscriber(self, event_loop: eventing.EventLoop = None) -> Subscriber:
+        """Returns a new subscriber, whose listeners are called by the event loop, by default on the reader thread."""
+        return Subscriber(self, event_loop or eventing.ImmediateEventLoop())
+
+    def subscribe(self, subscriber: Subscriber, topics: Iterable[str]):
+        with self._lock:
+            for topic in topics:
+                if topic in ('open', 'error'):
+                    continue  # Not topics, dispatched to all subscribers.
+                subscribers = self._subscribers_by_topic.get(topic)
+                if subscribers is None:
+                    subscribers = ()
+                    self._pending.add(topic)
+                if subscriber not in subscribers:
+                    self._subscribers_by_topic[topic] = subscribers + (subscriber,)
+            if self._pending:
+                self._schedule(subscribe_delay)
+
+    def remove(self, subscriber: Subscriber):
+        """Removes the subscriber from all topics, and closes the connection if it was the last one."""
+        with self._lock:
+            for topic, subscribers in list(self._subscribers_by_topic.items()):
+                if subscriber in subscribers:
+                    subscribers = tuple(s for s in subscribers if s is not subscriber)
+                    if subscribers:
+                        self._subscribers_by_topic[topic] = subscribers
+                    else:
+                        del self._subscribers_by_topic[topic]
+                        self._pending.discard(topic)
+            if not self._subscribers_by_topic and self._event_source is not None:
+                self._event_source.close()
+                self._event_source = None
+                self.connection_id = None
+
+    def _schedule(self, delay: float):
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if not self._pending:
+                return
+            topics = sorted(self._pending)
+            if self._event_source is None:
+                self._pending.clear()
+                self._event_source = _MultiplexedEventSource(
+                    self.base_url + 'connection?topics=' + ','.join(topics), self)
+                self._event_source.connect()
+                return
+            if self.connection_id is None:
+                return  # Sent as soon as the connection is open.
+            self._pending.clear()
+            connection_id = self.connection_id
+        try:
+            response = requests.post(self.base_url + 'subscribe', json=dict(connectionId=connection_id, topics=topics))
+            response.raise_for_status()
+        except requests.RequestException:
+            # The topics are sent again when the client reconnects.
+            logging.exception('Subscribing to %s failed', topics)
+
+    def route(self, event_source: _MultiplexedEventSource, event: Event):
+        if event_source is not self._event_source:
+            return  # A closed connection.
+        if event.type == 'open':
+            self._on_open(event)
+        elif event.type == 'error':
+            self._on_error(event_source)
+        if event.type in ('open', 'error'):
+            subscribers = {s for subscribers in self._subscribers_by_topic.values() for s in subscribers}
+        else:
+            subscribers = self._subscribers_by_topic.get(event.type, ())
+        for subscriber in subscribers:
+            subscriber.dispatch_event(event)
+
+    def _on_open(self, event: Event):
+        data = json.loads(event.data)
+        with self._lock:
+            # Each (re)connection has a new id, and only knows the topics of its URL.
+            self.connection_id = data['connectionId']
+            self._pending = set(self._subscribers_by_topic) - set(data['topics'])
+            if self._pending:
+                self._schedule(0)
+
+    def _on_error(self, event_source: _MultiplexedEventSource):
+        # client.EventSource gives up if the connection cannot be opened, so open a new one later.
+        with self._lock:
+            if event_source is self._event_source:
+                self._event_source = None
+                self.connection_id = None
+                self._pending = set(self._subscribers_by_topic)
+                if self._pending:
+                    self._schedule(reconnect_delay)
@@ -0,0 +1,76 @@
+"""
+    state_cache.py
+
+    Caches the encoded event of a routed state topic, see routes.route().
+    Concurrent requests for the same state share one computation (single flight), so that a burst of reconnecting
+    clients does not run the same expensive query once per client.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from appchen import serialization
+from appchen.server_send_events import server
+
+
+class StateCache:
+    """
+    The cached frame is valid for ttl seconds (forever if ttl is None) or until invalidate() is called.
+    A ttl of 0 means that the frame is only shared by concurrent requests.
+    """
+
+    def __init__(self, topic: str, compute: Callable[[], dict], ttl: Optional[float] = 0):
+        self.topic = topic
+        self.ttl = ttl
+        # Incremented on each invalidation. A computation started before an invalidation is not cached.
+        self.version = 0
+        self._compute = compute
+        self._lock = threading.Lock()
+        self._valid = False
+        self._frame: Optional[server.Frame] = None
+        self._expires_at = 0.0
+        self._inflight: Optional[Future] = None
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._valid = False
+            self._frame = None
+            self._inflight = None
+
+    def get(self) -> Optional[server.Frame]:
+        """Returns the encoded state event, or None if the state function returned a falsy value."""
+        with self._lock:
+            if self._valid and (self.ttl is None or time.monotonic() < self._expires_at):
+                return self._frame
+            future = self._inflight
+            if future is not None:
+                owner = False
+            else:
+                owner = True
+                future = self._inflight = Future()
+                version = self.version
+
+        if not owner:
+            return future.result()
+
+        try:
+            event = self._compute()
+            frame = server.encode_event(self.topic, serialization.dumps(event)) if event else None
+        except BaseException as e:
+            with self._lock:
+                if self._inflight is future:
+                    self._inflight = None
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if self._inflight is future:
+                self._inflight = None
+            if version == self.version and self.ttl != 0:
+                self._valid = True
+                self._frame = frame
+                self._expires_at = time.monotonic() + (self.ttl or 0)
+        future.set_result(frame)
+        return frame
@@ -94,11 +94,15 @@ export function stream(rootPath) {
     ev.eventSource.addEventListener('connection_open', function (event) {
         const data = JSON.parse(event.data);
         ev.connectionId = data['connectionId'];
+        // Topics passed when opening the connection are already subscribed.
+        const subscribedTopics = new Set(data['topics'] || []);
         const topicTypes = new Set();
         for (const /**@type{AppChenNS.SubscriptionHandlers}*/topics of ev.subscriptionConfigs) {
-            Object.keys(topics).forEach(topic => topicTypes.add(topic));
+            Object.keys(topics).filter(topic => !subscribedTopics.has(topic)).forEach(topic => topicTypes.add(topic));
+        }
+        if (topicTypes.size) {
+            ev.sendTopics(topicTypes);
         }
-        ev.sendTopics(topicTypes);
     });
 
     streamObj = {
@@ -2,8 +2,7 @@ import json
 import argparse
 import logging
 
-import requests
-
+from appchen.eventing import ThreadPoolEventLoop
 from appchen.server_send_events.client import EventSource, Event
 
 
@@ -13,18 +12,9 @@ parser.add_argument("--httpport", required=True, type=int)
 args = parser.parse_args()
 
 base_url = f'http://localhost:{args.httpport}/@appchen/web_client/stream/'
-es = EventSource(base_url + 'connection')
-
-
-@es.route('connection_open')
-def on_connection_open(event: Event):
-    data: dict = json.loads(event.data)
-    # logging.info(data['connectionId'])
-    r = requests.post(base_url + 'subscribe', data=json.dumps({
-        'connectionId': data['connectionId'],
-        'topics': ['zen', 'trade_executions_state', 'trade_executions']
-    }))
-    assert r.ok
+# Subscribe when opening the connection, no separate subscribe request needed.
+es = EventSource(base_url + 'connection?topics=zen,trade_executions_state,trade_executions',
+                 event_loop=ThreadPoolEventLoop())
 
 
 @es.route('zen')
@@ -43,3 +33,6 @@ def on_trade_executions(event: Event):
 def on_trade_executions_state(event: Event):
     data: dict = json.loads(event.data)
     logging.debug(data)
+
+
+es.connect()
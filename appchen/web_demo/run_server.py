@@ -9,7 +9,9 @@ import time
 import itertools
 import pathlib
 from this import d, s
-from flask import Flask, jsonify, redirect
+from flask import Flask, redirect, send_from_directory
+from appchen import assets
+from appchen.serialization import json_response
 from appchen.server_send_events import routes, server
 import appchen.weblet as weblet
 from random import randint, random
@@ -42,6 +44,7 @@ app.config['db'] = db
 
 app.register_blueprint(routes.app, url_prefix='/@appchen/web_client')
 app.register_blueprint(weblet.app, url_prefix='/@appchen/weblet')
+app.register_blueprint(assets.app, url_prefix='/@appchen/assets')
 
 trade_execution_schema = {'type': 'object', 'properties': {
     'delivery': {'columnIndex': 0, 'type': 'string', 'width': 200},
@@ -57,7 +60,15 @@ def get_home():
     return redirect('/@appchen/web_demo/myapp.html')
 
 
-@routes.route('trade_executions_state')
+@app.route("/@appchen/web_demo/<path:path>", methods=['GET'])
+def get_demo_file(path: str):
+    """Serves the demo pages and modules with fingerprinted URLs of the web_client assets."""
+    if path.endswith(('.html', '.js')):
+        return assets.send_rewritten(static_folder, path)
+    return send_from_directory(static_folder, path)
+
+
+@routes.route('trade_executions_state', cache_ttl=None, invalidated_by=['trade_executions'])
 def trade_executions_state():
     # Simulate network delay
     time.sleep(1.0)
@@ -66,8 +77,7 @@ def trade_executions_state():
     trades = []
 
     for trade in cursor:
-        trade['id'] = str(trade['_id'])
-        del trade['_id']
+        trade['id'] = trade.pop('_id')
         trades.append(trade)
 
     rows_of_object_schema = {
@@ -86,7 +96,7 @@ def time_state():
 
 @app.route("/trade_executions", methods=['GET'])
 def get_trade_executions():
-    return jsonify(trade_executions_state())
+    return json_response(trade_executions_state())
 
 
 def pump_zen():
@@ -120,8 +130,7 @@ def pump_trade_executions():
             )
             price += randint(-10, 10) / 10
             db.get_collection('trade_executions').insert_one(trade)
-            trade['id'] = str(trade['_id'])
-            del trade['_id']
+            trade['id'] = trade.pop('_id')
             server.broadcast('trade_executions', dict(trades=[trade]))
 
     server.declare_topic('trade_executions', 'Trades occurred. Price is in [€/MWh], quantity is in [MW]',
@@ -3,11 +3,23 @@
 
 import logging
 import datetime
+import functools
+import hashlib
+import itertools
 import pathlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
 import pymongo
-from pymongo.errors import ServerSelectionTimeoutError
-from flask import Response, request, jsonify, Blueprint, send_from_directory
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
+from flask import Response, request, Blueprint
 
+from appchen import assets
+from appchen.serialization import dumps, json_response
 from appchen.server_send_events import server
 from appchen.server_send_events.routes import route
 
@@ -19,27 +31,180 @@ app = Blueprint('weblet', __name__, static_folder=static_folder, static_url_path
 app.record(lambda state: globals().setdefault('db', state.app.config.get('db', None)))
 
 
-def import_weblets(src_dir: pathlib.Path):
-    """Initializes the database."""
-    logging.warning(f'Dropping weblets collection from database')
+@app.record
+def ensure_indexes(state):
+    """Supports the lookup of the latest weblet by name."""
+    if globals().get('db') is None:
+        return
+    try:
+        db.get_collection('weblets').create_index([('name', pymongo.ASCENDING), ('createAt', pymongo.DESCENDING)])
+    except PyMongoError as e:
+        logging.warning('Could not ensure weblets index: %r', e)
+
+
+# The latest weblet by name. Weblets change rarely, so the cache is cleared on any change.
+_current_weblet_by_name: Dict[str, dict] = dict()
+# The transitive weblet imports by name, see module_preloads().
+_preloads_by_name: Dict[str, Tuple[str, ...]] = dict()
+_cache_generation = 0
+_cache_lock = threading.Lock()
+
+
+def invalidate_cache():
+    global _cache_generation
+    with _cache_lock:
+        _current_weblet_by_name.clear()
+        _preloads_by_name.clear()
+        _cache_generation += 1
+
+
+server.add_broadcast_listener('weblet_upsert', invalidate_cache)
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(code.encode('utf8')).hexdigest()
+
+
+def store_code(codes: Iterable[str]) -> List[str]:
+    """Stores the code content-addressed, each distinct code only once. Returns the hashes of the codes."""
+    hashes = []
+    operations = []
+    for code in codes:
+        hash_ = code_hash(code)
+        hashes.append(hash_)
+        operations.append(UpdateOne({'_id': hash_}, {'$setOnInsert': {'code': code}}, upsert=True))
+    if operations:
+        db.get_collection('weblet_code').bulk_write(operations, ordered=False)
+    return hashes
+
+
+@functools.lru_cache(maxsize=256)
+def load_code(hash_: str) -> str:
+    """Returns the code of the hash. Code is immutable, so it is cached without invalidation."""
+    content = db.get_collection('weblet_code').find_one({'_id': hash_})
+    if content is None:
+        raise KeyError(hash_)  # Not cached
+    return content['code']
+
+
+def weblet_code(weblet: dict) -> str:
+    # Weblets stored before content addressing contain their code.
+    return weblet['code'] if 'code' in weblet else load_code(weblet['codeHash'])
+
+
+def _read_weblet(path: pathlib.Path) -> Tuple[str, str]:
+    code = path.read_text(encoding='utf8')
+    return code, code_hash(code)
+
+
+class ImportReport(NamedTuple):
+    imported: List[str]
+    skipped: List[str]
+
+
+def import_weblets(src_dir: pathlib.Path, max_workers: int = 8) -> ImportReport:
+    """Imports the weblets of the directory, skipping those whose code equals the latest version in the database.
+    Previous versions are kept."""
+    logging.info('Importing weblets from %s', src_dir.resolve())
     collection: pymongo.collection.Collection = db.get_collection('weblets')
-    collection.drop()
-    logging.info(f'Importing weblets from {src_dir.resolve()}')
-    weblets = src_dir.glob('*.js')
-    for path in weblets:
-        logging.info(f'Importing weblet {path}')
-        weblet = dict(
-            code=path.read_text(encoding='utf8'),
-            name=path.stem,
-            createAt=datetime.datetime.utcnow(),
-            createBy='importer'
-        )
-        collection.insert_one(weblet)
+    paths = sorted(src_dir.glob('*.js'))
+    with ThreadPoolExecutor(max_workers, thread_name_prefix='import_weblets') as executor:
+        files = list(executor.map(_read_weblet, paths))
 
+    names = [path.stem for path in paths]
+    latest_hash_by_name = dict()
+    for latest in collection.aggregate([
+        {'$match': {'name': {'$in': names}}},
+        {'$sort': {'name': pymongo.ASCENDING, 'createAt': pymongo.DESCENDING}},
+        {'$group': {
+            '_id': '$name',
+            'codeHash': {'$first': '$codeHash'},
+            # Weblets inserted before code hashes were stored are hashed here.
+            'code': {'$first': {'$cond': [{'$eq': [{'$type': '$codeHash'}, 'missing']}, '$code', None]}}
+        }}
+    ]):
+        latest_hash_by_name[latest['_id']] = latest.get('codeHash') or code_hash(latest.get('code') or '')
 
-def current_weblet(name: str):
-    """Returns the latest weblet of the specified name."""
-    return db.get_collection('weblets').find_one({"name": name}, sort=[('createAt', pymongo.DESCENDING)])
+    report = ImportReport([], [])
+    codes = []
+    weblets = []
+    create_at = datetime.datetime.now(tz=datetime.timezone.utc)
+    for name, (code, hash_) in zip(names, files):
+        if latest_hash_by_name.get(name) == hash_:
+            report.skipped.append(name)
+            continue
+        report.imported.append(name)
+        codes.append(code)
+        weblets.append(dict(codeHash=hash_, name=name, createAt=create_at, createBy='importer'))
+
+    if weblets:
+        store_code(codes)
+        collection.insert_many(weblets, ordered=False)
+        invalidate_cache()
+        for weblet in weblets:
+            weblet['id'] = weblet.pop('_id')
+            server.broadcast('weblet_upsert', weblet)
+    logging.info('Imported weblets %s, skipped unchanged weblets %s', report.imported, report.skipped)
+    return report
+
+
+def current_weblet(name: str) -> Optional[dict]:
+    """Returns a copy of the latest weblet of the specified name."""
+    weblet = _current_weblet_by_name.get(name)
+    if weblet is None:
+        generation = _cache_generation
+        weblet = db.get_collection('weblets').find_one({"name": name}, sort=[('createAt', pymongo.DESCENDING)])
+        if weblet is None:
+            return None
+        with _cache_lock:
+            # Do not cache a weblet which may have been replaced in the meantime.
+            if generation == _cache_generation:
+                _current_weblet_by_name[name] = weblet
+    return dict(weblet)
+
+
+# Static import and export-from declarations of modules in the same directory, i.e. of other weblets.
+# Comments and string literals are matched as a whole, so that imports within them are skipped.
+_import_pattern = re.compile(
+    r'''//[^\n]*|/\*.*?\*/|`(?:\\.|[^\\`])*`'''
+    r'''|\b(?:import|export)\b[^'"`();]*?(['"])\./([\w-]+)\.js\1'''
+    r'''|'(?:\\.|[^\\'\n])*'|"(?:\\.|[^\\"\n])*"''', re.DOTALL)
+
+
+def module_preloads(name: str) -> Tuple[str, ...]:
+    """Returns the names of the weblets imported directly or indirectly by the weblet, dependencies first."""
+    preloads = _preloads_by_name.get(name)
+    if preloads is None:
+        generation = _cache_generation
+        order = []
+        visited = {name}
+
+        def visit(weblet: dict):
+            for match in _import_pattern.finditer(weblet_code(weblet)):
+                imported = match.group(2)
+                if imported is None or imported in visited:
+                    continue
+                visited.add(imported)
+                imported_weblet = current_weblet(imported)
+                if imported_weblet is not None:
+                    visit(imported_weblet)
+                    order.append(imported)
+
+        root = current_weblet(name)
+        if root is not None:
+            visit(root)
+        preloads = tuple(order)
+        with _cache_lock:
+            if generation == _cache_generation:
+                _preloads_by_name[name] = preloads
+    return preloads
+
+
+def conditional_response(response: Response, etag: str) -> Response:
+    """Lets browsers revalidate with If-None-Match."""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 
 @app.errorhandler(ServerSelectionTimeoutError)
@@ -47,67 +212,131 @@ def db_error_handler(error):
     return f'Database connection failed: {str(error)}', 500
 
 
-@route('weblets_state')
-def weblets_state():
-    schema = {
-        "title": 'Weblets',
-        "type": 'array',
-        "items": {
-            "type": 'object',
-            "properties": {
-                "name": {"title": 'Name', "type": 'string', "format": 'uri', "width": 100},
-                "createAt": {
-                    "title": 'Create At', "type": 'string', "format": 'date-time', "period": 'MILLISECONDS',
-                    "width": 300
-                },
-                "createBy": {"title": 'Create By', "type": 'string', "width": 200},
-                "id": {"title": 'Id', "type": 'string', "width": 200}
-            }
+weblets_schema = {
+    "title": 'Weblets',
+    "type": 'array',
+    "items": {
+        "type": 'object',
+        "properties": {
+            "name": {"title": 'Name', "type": 'string', "format": 'uri', "width": 100},
+            "createAt": {
+                "title": 'Create At', "type": 'string', "format": 'date-time', "period": 'MILLISECONDS',
+                "width": 300
+            },
+            "createBy": {"title": 'Create By', "type": 'string', "width": 200},
+            "id": {"title": 'Id', "type": 'string', "width": 200}
         }
     }
+}
+
+
+def list_weblets(latest: bool = False, after: Optional[str] = None, limit: int = 0) -> Iterator[dict]:
+    """Yields the weblets without their code, either all versions in order of creation or the latest version of each
+    weblet in order of name. For the next page pass the id, or with latest the name, of the last weblet as after."""
+    collection = db.get_collection('weblets')
+    if latest:
+        pipeline = [{'$match': {'name': {'$gt': after}}}] if after is not None else []
+        pipeline += [
+            {'$sort': {'name': pymongo.ASCENDING, 'createAt': pymongo.DESCENDING}},
+            {'$project': {'code': False}},
+            {'$group': {'_id': '$name', 'weblet': {'$first': '$$ROOT'}}},
+            {'$replaceRoot': {'newRoot': '$weblet'}},
+            {'$sort': {'name': pymongo.ASCENDING}},
+        ]
+        if limit:
+            pipeline.append({'$limit': limit})
+        cursor = collection.aggregate(pipeline)
+    else:
+        query = {'_id': {'$gt': ObjectId(after)}} if after is not None else {}
+        cursor = collection.find(query, {'code': False}, sort=[('_id', pymongo.ASCENDING)], limit=limit)
+    for weblet in cursor:
+        # The ObjectId and the createAt datetime are serialized by appchen.serialization.
+        weblet['id'] = weblet.pop('_id')
+        yield weblet
 
-    weblets_cursor = db.get_collection('weblets').find({}, sort=[('createAt', pymongo.ASCENDING)])
-    weblets = []
-    for weblet in weblets_cursor:
-        weblet['id'] = str(weblet['_id'])
-        del weblet['_id']
-        create_at: datetime.datetime = weblet['createAt']
-        weblet['createAt'] = create_at.isoformat()
-        weblets.append(weblet)
 
-    return dict(schema=schema, weblets=weblets)
+@route('weblets_state', cache_ttl=None, invalidated_by=['weblet_upsert'])
+def weblets_state():
+    return dict(schema=weblets_schema, weblets=list(list_weblets()))
 
 
 @app.route("editor.html", methods=['GET'])
 def get_editor():
-    return send_from_directory(static_folder, "editor.html")
+    return assets.send_rewritten(static_folder, "editor.html")
 
 
 @app.route("/weblets", methods=['GET'])
 def get_weblets():
-    return jsonify(weblets_state())
+    """Streams the weblets in the format of weblets_state, see list_weblets() for the query parameters
+    latest, after and limit."""
+    after = request.args.get('after')
+    latest = request.args.get('latest', 'false').lower() == 'true'
+    if after is not None and not latest and not ObjectId.is_valid(after):
+        return json_response(dict(error='Invalid cursor'), 400)
+    weblets = list_weblets(latest, after, request.args.get('limit', 0, type=int))
+    # Runs the query before the response starts, so that database errors still reach the error handler.
+    first = next(weblets, None)
+
+    def generate():
+        parts = [f'{{"schema": {dumps(weblets_schema)}, "weblets": [']
+        for i, weblet in enumerate(itertools.chain([first], weblets) if first is not None else ()):
+            parts.append(',' + dumps(weblet) if i else dumps(weblet))
+            if len(parts) == 100:  # Fewer, larger writes
+                yield ''.join(parts)
+                parts.clear()
+        parts.append(']}')
+        yield ''.join(parts)
+
+    return Response(generate(), mimetype='application/json')
 
 
 @app.route("<name>.js", methods=['GET'])
 def get_weblet_code(name: str):
     weblet = current_weblet(name)
     if weblet is None:
-        return jsonify(error='weblet not found'), 404
-    return Response(response=weblet['code'], mimetype="application/javascript; charset=utf-8")
+        return json_response(dict(error='weblet not found'), 404)
+    # Imports of web_client modules share the fingerprinted URLs of the page, so that each module is loaded once.
+    code = assets.rewrite(weblet_code(weblet))
+    # Saving unchanged code does not invalidate the browser cache, but new assets do.
+    etag = weblet.get('codeHash') or str(weblet['_id'])
+    if assets.fingerprint:
+        etag += '-' + assets.fingerprint
+    preloads = module_preloads(name)
+    if preloads:
+        # Hoisting all transitive imports lets the browser request them at once instead of discovering them level by
+        # level. In this order the modules are evaluated as before. The prefix keeps the line numbers of the code.
+        prefix = ''.join(f'import "./{preload}.js";' for preload in preloads)
+        code = prefix + code
+        etag += '-' + code_hash(prefix)[:16]
+    response = Response(response=code, mimetype="application/javascript; charset=utf-8")
+    return conditional_response(response, etag)
 
 
 @app.route("<name>", methods=['GET'])
 def get_weblet(name: str):
     weblet = current_weblet(name)
     if weblet is None:
-        return jsonify(error='Weblet not found'), 404
-    del weblet['_id']
-    return jsonify(weblet)
+        return json_response(dict(error='Weblet not found'), 404)
+    # Clients fetch the code by its codeHash, only weblets stored before content addressing contain their code.
+    response = json_response({key: value for key, value in weblet.items() if key != '_id'})
+    return conditional_response(response, str(weblet['_id']))
+
+
+@app.route("code/<hash_>", methods=['GET'])
+def get_code(hash_: str):
+    try:
+        code = load_code(hash_)
+    except KeyError:
+        return json_response(dict(error='Code not found'), 404)
+    response = Response(response=code, mimetype="application/javascript; charset=utf-8")
+    response.set_etag(hash_)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 # schema = {'properties': {'name': {'type': 'string', 'format': 'uri'}}}
 server.declare_topic('weblet_upsert', 'A weblet was created or changed', {
-    "code": "Some JavaScript es6 module code",
+    "codeHash": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08",
     "createAt": "2020-01-24T13:37:18.269714+00:00",
     "id": "5e2af30e5e6d266444f1c703",
     "name": "weblet3"
@@ -118,10 +347,10 @@ server.declare_topic('weblet_upsert', 'A weblet was created or changed', {
 def post_weblet(name: str):
     weblet: dict = request.get_json(force=True)
     weblet['name'] = name
+    weblet['codeHash'] = store_code([weblet.pop('code', '')])[0]
     weblet['createAt'] = datetime.datetime.now(tz=datetime.timezone.utc)
     db.get_collection('weblets').insert_one(weblet)
-    weblet['createAt'] = weblet['createAt'].isoformat()
-    weblet['id'] = str(weblet['_id'])
-    del weblet['_id']
+    invalidate_cache()
+    weblet['id'] = weblet.pop('_id')
     server.broadcast('weblet_upsert', weblet)
-    return jsonify(message='Inserted weblet.')
\ No newline at end of file
+    return json_response(dict(message='Inserted weblet.'))
\ No newline at end of file
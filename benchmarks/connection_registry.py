@@ -0,0 +1,75 @@
+"""
+Benchmarks subscribe/remove churn of the connection registry while broadcasts are running concurrently.
+
+Usage:
+    python -m benchmarks.connection_registry --connections=10000
+"""
+import argparse
+import threading
+import time
+import random
+
+from appchen.server_send_events import server
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--connections", default=10000, type=int)
+parser.add_argument("--topics", default=50, type=int)
+parser.add_argument("--topics-per-connection", default=5, type=int)
+args = parser.parse_args()
+
+topics = [f'topic_{i}' for i in range(args.topics)]
+for topic in topics:
+    server.declare_topic(topic, 'A benchmark topic')
+
+
+def timed(label: str, count: int, f):
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<30} {elapsed * 1000:10.1f} ms {elapsed / count * 1e6:10.2f} µs/op')
+
+
+connections = []
+timed('create', args.connections,
+      lambda: connections.extend(server.Connection() for _ in range(args.connections)))
+
+subscriptions = [random.sample(topics, args.topics_per_connection) for _ in connections]
+timed('subscribe', args.connections,
+      lambda: [server.subscribe(c, t) for c, t in zip(connections, subscriptions)])
+
+ids = [c.id for c in connections]
+timed('lookup by id', args.connections, lambda: [server.get_connection_by_id(guid) for guid in ids])
+
+broadcasts = 0
+stop = threading.Event()
+
+
+def broadcaster():
+    global broadcasts
+    while not stop.is_set():
+        server.broadcast(random.choice(topics), dict(broadcasts=broadcasts))
+        broadcasts += 1
+
+
+threads = [threading.Thread(target=broadcaster) for _ in range(4)]
+for thread in threads:
+    thread.start()
+
+
+def churn():
+    for i, connection in enumerate(connections):
+        connection.remove()
+        replacement = server.Connection()
+        server.subscribe(replacement, subscriptions[i])
+        connections[i] = replacement
+
+
+timed('churn (remove + subscribe)', args.connections, churn)
+stop.set()
+for thread in threads:
+    thread.join()
+print(f'{broadcasts} concurrent broadcasts without error')
+
+timed('remove', args.connections, lambda: [c.remove() for c in connections])
+assert len(server.registry) == 0
+assert server.registry.topics() == []
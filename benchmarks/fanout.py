@@ -0,0 +1,175 @@
+"""
+Measures the fan-out of broadcasts to many concurrent SSE clients end to end.
+
+Serves the streaming and weblet blueprints locally, the latter with an in-memory stand-in for MongoDB. Then it
+opens the clients in a separate process (asyncio clients, so that they do not compete with the server for the GIL),
+broadcasts at the given rate and payload size, and reports delivery throughput, latency from broadcast to client,
+memory and threads of the server process.
+
+Usage:
+    python -m benchmarks.fanout --clients=200 --rate=50 --payload=1024 --duration=10
+    python -m benchmarks.fanout --engine=asgi  # requires uvicorn
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import threading
+import time
+
+from flask import Flask
+
+from appchen import weblet
+from appchen.server_send_events import asgi, routes, server
+from appchen.server_send_events.aioclient import EventSource
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class MemoryCollection:
+    """Just enough of a pymongo collection for the weblet blueprint to start and list weblets."""
+
+    def __init__(self):
+        self.documents = []
+
+    def create_index(self, keys):
+        pass
+
+    def find(self, query=None, projection=None, sort=None, limit=0):
+        return [dict(document) for document in self.documents]
+
+    def aggregate(self, pipeline):
+        return []
+
+
+class MemoryDatabase:
+
+    def __init__(self):
+        self._collections = dict()
+
+    def get_collection(self, name: str) -> MemoryCollection:
+        return self._collections.setdefault(name, MemoryCollection())
+
+
+def serve(engine: str, port: int):
+    if engine == 'asgi':
+        import uvicorn
+        config = uvicorn.Config(asgi.app, port=port, log_level='warning')
+        target = uvicorn.Server(config).run
+    else:
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)  # One line per connection
+        app = Flask(__name__)
+        app.config['db'] = MemoryDatabase()
+        app.register_blueprint(routes.app, url_prefix='/@appchen/web_client')
+        app.register_blueprint(weblet.app, url_prefix='/@appchen/weblet')
+        target = make_server('127.0.0.1', port, app, threaded=True).serve_forever
+    threading.Thread(target=target, daemon=True).start()
+
+
+def run_clients(url: str, count: int, conn):
+    """Runs in the client process. Reports 'ready' once all clients are open, and the latencies when told to stop."""
+    asyncio.run(_clients(url, count, conn))
+
+
+async def _clients(url: str, count: int, conn):
+    latencies = []
+    opened = 0
+    all_open = asyncio.Event()
+
+    def on_bench(event):
+        latencies.append(time.time() - json.loads(event.data)['t'])
+
+    def on_open(event):
+        nonlocal opened
+        opened += 1
+        if opened == count:
+            all_open.set()
+
+    event_sources = []
+    for _ in range(count):
+        event_source = EventSource(url, headers={'Accept-Encoding': 'identity'})
+        event_source.add_event_listener('bench', on_bench)
+        event_source.add_event_listener('open', on_open)
+        event_source.connect()
+        event_sources.append(event_source)
+    await all_open.wait()
+    conn.send('ready')
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    for event_source in event_sources:
+        event_source.close()
+    conn.send(latencies)
+
+
+def percentile(values, q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float('nan')
+
+
+def max_rss_mb() -> float:
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", default='flask', choices=['flask', 'asgi'])
+    parser.add_argument("--port", default=8090, type=int)
+    parser.add_argument("--clients", default=100, type=int)
+    parser.add_argument("--rate", default=50.0, type=float, help='Broadcasts per second')
+    parser.add_argument("--payload", default=256, type=int, help='Bytes of padding per event')
+    parser.add_argument("--duration", default=10.0, type=float, help='Seconds')
+    args = parser.parse_args()
+
+    serve(args.engine, args.port)
+    url = f'http://127.0.0.1:{args.port}/@appchen/web_client/stream/connection?topics=bench'
+    if args.engine == 'asgi':
+        url = f'http://127.0.0.1:{args.port}/stream/connection?topics=bench'
+
+    conn, child_conn = multiprocessing.Pipe()
+    # Spawn, because forking a process with running server threads is unsafe.
+    clients = multiprocessing.get_context('spawn').Process(
+        target=run_clients, args=(url, args.clients, child_conn), daemon=True)
+    clients.start()
+    start = time.perf_counter()
+    if not conn.poll(60):
+        raise TimeoutError('Clients did not connect')
+    conn.recv()
+    print(f'{args.clients} clients connected in {time.perf_counter() - start:.1f}s, '
+          f'{len(server.registry)} server connections, {threading.active_count()} threads')
+
+    padding = 'x' * args.payload
+    sent = 0
+    peak_threads = 0
+    start = time.perf_counter()
+    next_broadcast = start
+    while next_broadcast < start + args.duration:
+        time.sleep(max(0.0, next_broadcast - time.perf_counter()))
+        server.broadcast('bench', dict(t=time.time(), seq=sent, pad=padding))
+        sent += 1
+        next_broadcast += 1 / args.rate
+        peak_threads = max(peak_threads, threading.active_count())
+    elapsed = time.perf_counter() - start
+    time.sleep(1)  # Drain
+
+    conn.send('stop')
+    latencies = sorted(conn.recv())
+    clients.join(10)
+
+    expected = sent * args.clients
+    snapshot = server.metrics_snapshot(0)
+    print(f'engine {args.engine}, {args.clients} clients, {sent / elapsed:.1f} broadcasts/s '
+          f'of {args.payload} bytes for {elapsed:.1f}s')
+    print(f'delivered     {len(latencies)} of {expected} events ({len(latencies) / elapsed:.0f} events/s), '
+          f'{sum(snapshot["dropped"].values())} dropped')
+    print(f'latency       p50 {percentile(latencies, 0.5) * 1000:.2f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.2f} ms, max {percentile(latencies, 1) * 1000:.2f} ms')
+    print(f'server        max rss {max_rss_mb():.0f} MB, peak {peak_threads} threads')
+
+
+if __name__ == '__main__':
+    main()
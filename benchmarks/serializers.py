@@ -0,0 +1,53 @@
+"""
+Compares the serializer backends of appchen.serialization on typical payloads.
+
+Usage:
+    python -m benchmarks.serializers
+"""
+import argparse
+import datetime
+import random
+import timeit
+
+from bson import ObjectId
+
+from appchen import serialization
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--trades", default=5000, type=int)
+parser.add_argument("--weblets", default=200, type=int)
+args = parser.parse_args()
+
+
+def trade():
+    return dict(
+        id=ObjectId(),
+        delivery=datetime.datetime(2020, 2, 1, random.randint(0, 23), 15 * random.randint(0, 3)).isoformat()[0:16]
+        + 'PT15M',
+        executionTime=datetime.datetime.now(tz=datetime.timezone.utc),
+        quantity=random.randint(1, 40) / 10,
+        price=round(random.randint(400, 600) / 10, 2)
+    )
+
+
+def weblet(i: int):
+    return dict(id=ObjectId(), name=f'weblet{i}', createAt=datetime.datetime.now(tz=datetime.timezone.utc),
+                createBy='importer', code='export function render(element) {\n    element.textContent = "x";\n}\n' * 80)
+
+
+payloads = dict(
+    trade_executions=dict(trades=[trade()]),
+    trade_executions_state=dict(schema={'type': 'array'}, data=[trade() for _ in range(args.trades)]),
+    weblets_state=dict(schema={'type': 'array'}, weblets=[weblet(i) for i in range(args.weblets)]),
+)
+
+print(f'{"payload":<25}{"serializer":<10}{"size":>10}{"µs/op":>12}')
+for name, payload in payloads.items():
+    baseline = None
+    for serializer_name, dumps in serialization.serializers.items():
+        size = len(dumps(payload))
+        timer = timeit.Timer(lambda: dumps(payload))
+        count, _ = timer.autorange()
+        elapsed = min(timer.repeat(3, count)) / count
+        baseline = baseline or elapsed
+        print(f'{name:<25}{serializer_name:<10}{size:>10}{elapsed * 1e6:>12.1f}  x{baseline / elapsed:.1f}')
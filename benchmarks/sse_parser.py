@@ -0,0 +1,80 @@
+"""
+Compares the incremental parser of appchen.server_send_events.parser with the former parsing of SSEClient1,
+which concatenated the decoded chunks to a string buffer and split it with a regular expression.
+
+Usage:
+    python -m benchmarks.sse_parser
+"""
+import argparse
+import codecs
+import json
+import re
+import time
+
+from sseclient import Event
+
+from appchen.server_send_events.parser import EventStreamParser
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--chunk-size", default=10 * 1024, type=int)
+parser.add_argument("--snapshot-bytes", default=5 * 1024 * 1024, type=int)
+parser.add_argument("--events", default=50000, type=int)
+args = parser.parse_args()
+
+end_of_field = re.compile(r'\r\n\r\n|\r\r|\n\n')
+
+
+def string_buffer_parse(chunks):
+    """The former SSEClient1.__next__ loop."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buf = ''
+    count = 0
+    chunks = iter(chunks)
+    while True:
+        pos = 0
+        while end_of_field.search(buf, pos) is None:
+            try:
+                next_chunk = next(chunks)
+            except StopIteration:
+                return count
+            pos = max(0, len(buf) - 4)
+            buf += decoder.decode(next_chunk)
+        (event_string, buf) = re.split(end_of_field, buf, maxsplit=1)
+        Event.parse(event_string)
+        count += 1
+
+
+def bytes_parse(chunks):
+    event_parser = EventStreamParser()
+    count = 0
+    for chunk in chunks:
+        count += len(event_parser.feed(chunk))
+    return count
+
+
+def stream(events):
+    data = b''.join(events)
+    return [data[i:i + args.chunk_size] for i in range(0, len(data), args.chunk_size)]
+
+
+def encode(event_type: str, data: str, sequence: int) -> bytes:
+    return f'event: {event_type}\ndata: {data}\nid: abcd-{sequence}\n\n'.encode()
+
+
+row = json.dumps(dict(id='5e3a8c3e1f2b4c0001a1b2c3', delivery='2020-02-01T10:15PT15M', quantity=1.2, price=45.6))
+rows = max(1, args.snapshot_bytes // (len(row) + 1))
+streams = dict(
+    snapshot=stream([encode('trade_executions_state', '[' + ','.join([row] * rows) + ']', 1)]),
+    small_events=stream([encode('trade_executions', row, i) for i in range(args.events)]),
+)
+
+print(f'{"stream":<15}{"parser":<15}{"events":>8}{"MB/s":>10}')
+for name, chunks in streams.items():
+    size = sum(len(chunk) for chunk in chunks)
+    baseline = None
+    for parser_name, parse in (('string_buffer', string_buffer_parse), ('bytes', bytes_parse)):
+        start = time.perf_counter()
+        count = parse(chunks)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f'{name:<15}{parser_name:<15}{count:>8}{size / elapsed / 1e6:>10.1f}  x{baseline / elapsed:.1f}')
@@ -0,0 +1,24 @@
+from appchen.server_send_events.parser import EventStreamParser
+
+stream = (b'event: zen\r\ndata: a\r\n\r\n'
+          b'data: b\r\ndata: c\r\rid: 1\ndata: d\n\n'
+          b': keep alive\r\n\r\n'
+          b'data: \xc3\xa4\r\n\n'
+          b'retry: 100\ndata: e\r\n\r\n')
+
+
+def parse(chunks):
+    parser = EventStreamParser()
+    return [(event.event, event.data, event.id, event.retry) for chunk in chunks for event in parser.feed(chunk)]
+
+
+def test_independent_of_chunking():
+    whole = parse([stream])
+    assert whole == [('zen', 'a', None, None), ('message', 'b\nc', None, None), ('message', 'd', '1', None),
+                     ('message', 'ä', '1', None), ('message', 'e', '1', 100)]
+    assert parse([stream[i:i + 1] for i in range(len(stream))]) == whole
+
+
+def test_crlf_at_end_of_chunk():
+    assert parse([b'data: a\r\n', b'\n', b'data: b\n\n']) == [('message', 'a', None, None),
+                                                             ('message', 'b', None, None)]